@@ -1,9 +1,9 @@
+from functools import partial
 from datasets import load_dataset, Dataset
-from helpers.data import chunk_list, save_json
-from helpers.oai import async_gpt_calls
+from helpers.data import TaskFailure, queue, save_json
+from helpers.oai import async_gpt_calls, print_estimate
 from helpers.progress import Progress
-from pipelines.raw import run_raw
-import asyncio
+from pipelines.raw import estimate_raw, run_raw
 
 
 async def hotpot_validity():
@@ -14,19 +14,27 @@ async def hotpot_validity():
     if not isinstance(data, Dataset):
         raise TypeError("Expected a Dataset object")
 
-    progress = Progress(len(data), "Benchmarking Hotpot Validity")
-
-    batches = chunk_list(data["question"], 50)
+    print_estimate(estimate_raw(data["question"]))
 
-    results = []
+    progress = Progress(len(data), "Benchmarking Hotpot Validity")
 
-    for batch in batches:
-        results += await asyncio.gather(
-            *[run_raw("hotpot_raw", prompt, progress) for prompt in batch]
-        )
+    results = await queue(
+        [
+            partial(run_raw, "hotpot_raw", prompt, progress)
+            for prompt in data["question"]
+        ],
+        50,
+    )
 
     progress.finish()
 
+    results = [
+        {"question": prompt, "response": "An error occurred", "context": []}
+        if isinstance(result, TaskFailure)
+        else result
+        for prompt, result in zip(data["question"], results)
+    ]
+
     print("Evaluating results...")
 
     decisions = await async_gpt_calls(
@@ -48,7 +56,7 @@ async def hotpot_validity():
     )
 
     for result, decision in zip(results, decisions):
-        result["correct"] = str(decision).lower()[0] == "y"
+        result["correct"] = str(decision).lower().startswith("y")
 
     correct = sum(1 for r in results if r["correct"])
 
@@ -1,9 +1,9 @@
 from functools import partial
 from datasets import load_dataset, Dataset
-from helpers.data import chunk_list, queue, save_json
-from helpers.oai import async_gpt_calls
+from helpers.data import chunk_list, TaskFailure, queue, save_json
+from helpers.oai import async_gpt_calls, print_estimate
 from helpers.progress import Progress
-from pipelines.raw import run_raw
+from pipelines.raw import estimate_raw, run_raw
 import asyncio
 
 
@@ -15,6 +15,8 @@ async def pubmed_summarized():
     if not isinstance(data, Dataset):
         raise TypeError("Expected a Dataset object")
 
+    print_estimate(estimate_raw(data["question"]))
+
     progress = Progress(len(data), "Benchmarking PubMed summarizer")
 
     results = await queue(
@@ -26,6 +28,13 @@ async def pubmed_summarized():
 
     progress.finish()
 
+    results = [
+        {"question": prompt, "response": "An error occurred", "context": []}
+        if isinstance(result, TaskFailure)
+        else result
+        for prompt, result in zip(data["question"], results)
+    ]
+
     decisions = await async_gpt_calls(
         [
             f"""Please extract a one-word decision from the text that was answering this question (yes, no, maybe).
@@ -39,7 +48,7 @@ async def pubmed_summarized():
     )
 
     for result, decision, correct in zip(results, decisions, data["final_decision"]):
-        result["correct"] = str(decision).lower()[0] == correct.lower()[0]
+        result["correct"] = str(decision).lower()[:1] == correct.lower()[:1]
 
     correct = sum(1 for r in results if r["correct"])
 
@@ -1,9 +1,9 @@
+from functools import partial
 from datasets import load_dataset, Dataset
-from helpers.data import chunk_list, save_json
-from helpers.oai import async_gpt_calls
+from helpers.data import TaskFailure, queue, save_json
+from helpers.oai import async_gpt_calls, print_estimate
 from helpers.progress import Progress
-from pipelines.validity import run_validity
-import asyncio
+from pipelines.validity import estimate_validity, run_validity
 
 
 async def pubmed_validity():
@@ -14,19 +14,27 @@ async def pubmed_validity():
     if not isinstance(data, Dataset):
         raise TypeError("Expected a Dataset object")
 
-    progress = Progress(len(data), "Benchmarking PubMed Validity")
-
-    batches = chunk_list(data["question"], 50)
+    print_estimate(estimate_validity(data["question"]))
 
-    results = []
+    progress = Progress(len(data), "Benchmarking PubMed Validity")
 
-    for batch in batches:
-        results += await asyncio.gather(
-            *[run_validity("pubmed_raw", prompt, progress) for prompt in batch]
-        )
+    results = await queue(
+        [
+            partial(run_validity, "pubmed_raw", prompt, progress)
+            for prompt in data["question"]
+        ],
+        50,
+    )
 
     progress.finish()
 
+    results = [
+        {"question": prompt, "response": "An error occurred", "context": []}
+        if isinstance(result, TaskFailure)
+        else result
+        for prompt, result in zip(data["question"], results)
+    ]
+
     decisions = await async_gpt_calls(
         [
             f"""Please extract a one-word decision from the text that was answering this question (yes, no, maybe).
@@ -40,7 +48,7 @@ async def pubmed_validity():
     )
 
     for result, decision, correct in zip(results, decisions, data["final_decision"]):
-        result["correct"] = str(decision).lower()[0] == correct.lower()[0]
+        result["correct"] = str(decision).lower()[:1] == correct.lower()[:1]
 
     correct = sum(1 for r in results if r["correct"])
 
@@ -1,9 +1,9 @@
 from functools import partial
 from datasets import load_dataset, Dataset
-from helpers.data import queue, save_json
-from helpers.oai import async_gpt_calls
+from helpers.data import TaskFailure, queue, save_json
+from helpers.oai import async_gpt_calls, print_estimate
 from helpers.progress import Progress
-from pipelines.raw import run_raw
+from pipelines.raw import estimate_raw, run_raw
 import asyncio
 
 
@@ -15,6 +15,8 @@ async def squad_summarized():
     if not isinstance(data, Dataset):
         raise TypeError("Expected a Dataset object")
 
+    print_estimate(estimate_raw(data["question"]))
+
     progress = Progress(len(data), "Benchmarking Squad summarized")
 
     results = await queue(
@@ -26,6 +28,13 @@ async def squad_summarized():
 
     progress.finish()
 
+    results = [
+        {"question": prompt, "response": "An error occurred", "context": []}
+        if isinstance(result, TaskFailure)
+        else result
+        for prompt, result in zip(data["question"], results)
+    ]
+
     decisions = await async_gpt_calls(
         [
             f"""Please determine if the answer is correct (respond with yes or no).
@@ -74,8 +83,8 @@ async def squad_summarized():
         results, decisions, decisions_final_answer
     ):
         result["correct"] = (
-            str(decision).lower()[0] == "y"
-            or str(decision_final_answer).lower()[0] == "y"
+            str(decision).lower().startswith("y")
+            or str(decision_final_answer).lower().startswith("y")
         )
 
     correct = sum(1 for r in results if r["correct"])
@@ -1,6 +1,6 @@
 import asyncio
 from math import floor
-from helpers.pc import get_namespace_size, query_index
+from helpers.pc import namespace_stats
 
 datasets = ["pubmed", "squad", "hotpot"]
 
@@ -10,22 +10,12 @@ for i, dataset in enumerate(datasets):
 
 dataset = datasets[int(input()) - 1]
 
-raw = asyncio.run(
-    query_index("a", dataset + "_raw", top_k=10_000, include_metadata=True)
-)
-summarized = asyncio.run(
-    query_index("a", dataset + "_summarized", top_k=10_000, include_metadata=True)
-)
+raw = asyncio.run(namespace_stats(dataset + "_raw"))
+summarized = asyncio.run(namespace_stats(dataset + "_summarized"))
 
-raw_size = sum(len(str(x.metadata["content"])) for x in raw)
-summarized_size = sum(len(str(x.metadata["content"])) for x in summarized)
+raw_size = raw["content_length"]
+summarized_size = summarized["content_length"]
 
-raw_count = get_namespace_size(dataset + "_raw")
-summarized_count = get_namespace_size(dataset + "_summarized")
-
-raw_size = raw_size * len(raw) / raw_count
-summarized_size = summarized_size * len(summarized) / summarized_count
-
-print(f"Raw size: {floor(raw_size)}")
-print(f"Summarized size: {floor(summarized_size)}")
+print(f"Raw size: {floor(raw_size)} ({raw['count']} vectors)")
+print(f"Summarized size: {floor(summarized_size)} ({summarized['count']} vectors)")
 print(f"Ratio: {summarized_size / raw_size * 100 :.2f}%")
@@ -5,7 +5,7 @@ from helpers.oai import get_embeddings
 from helpers.pc import upsert_index
 
 
-async def hotpot_raw():
+async def hotpot_raw(batch=False):
     dataset = load_dataset("hotpotqa/hotpot_qa", "fullwiki", split="train")
 
     data = dataset.select_columns(["id", "context", "question", "supporting_facts"]).select(range(150))  # type: ignore
@@ -30,11 +30,13 @@ async def hotpot_raw():
         for context_id in used_contexts["title"]:
             context_to_ids[context_id].append(id)
 
-    embeddings = await get_embeddings(list(contexts.values()), progress_bar=True)
+    embeddings = await get_embeddings(
+        list(contexts.values()), progress_bar=True, batch=batch
+    )
 
-    upsert_index(
+    await upsert_index(
         "hotpot_raw",
-        [
+        (
             {
                 "id": id.encode("ascii", "ignore").decode("ascii"),
                 "values": embedding.vector,
@@ -45,7 +47,9 @@ async def hotpot_raw():
             }
             for embedding, (id, context) in zip(embeddings, contexts.items())
             if id.encode("ascii", "ignore").decode("ascii") != ""
-        ],
+        ),
+        total=len(embeddings),
+        progress=True,
     )
 
     print("Done")
@@ -5,7 +5,7 @@ from helpers.oai import get_embeddings
 from helpers.pc import upsert_index
 
 
-async def pubmed_raw():
+async def pubmed_raw(batch=False):
     dataset = load_dataset("qiaojin/PubMedQA", name="pqa_labeled", split="train")
 
     data = dataset.select_columns(["question", "context", "pubid"])
@@ -20,13 +20,13 @@ async def pubmed_raw():
 
     print("Getting embeddings...")
 
-    embeddings = await get_embeddings(contexts, progress_bar=True)
+    embeddings = await get_embeddings(contexts, progress_bar=True, batch=batch)
 
     print("Upserting embeddings...")
 
-    upsert_index(
+    await upsert_index(
         "pubmed_raw",
-        [
+        (
             {
                 "id": str(i),
                 "values": embedding.vector,
@@ -36,7 +36,9 @@ async def pubmed_raw():
                 },
             }
             for i, (embedding, context) in enumerate(zip(embeddings, contexts))
-        ],
+        ),
+        total=len(embeddings),
+        progress=True,
     )
 
     print("Done")
@@ -5,7 +5,7 @@ from helpers.oai import get_embeddings
 from helpers.pc import upsert_index
 
 
-async def squad_raw():
+async def squad_raw(batch=False):
     dataset = load_dataset("rajpurkar/squad", split="validation")
 
     data = dataset.select_columns(["id", "context", "question", "answers"])
@@ -24,13 +24,13 @@ async def squad_raw():
 
     print("Getting embeddings...")
 
-    embeddings = await get_embeddings(contexts, progress_bar=True)
+    embeddings = await get_embeddings(contexts, progress_bar=True, batch=batch)
 
     print("Upserting embeddings...")
 
-    upsert_index(
+    await upsert_index(
         "squad_raw",
-        [
+        (
             {
                 "id": str(i),
                 "values": embedding.vector,
@@ -40,7 +40,9 @@ async def squad_raw():
                 },
             }
             for i, (embedding, context) in enumerate(zip(embeddings, contexts))
-        ],
+        ),
+        total=len(embeddings),
+        progress=True,
     )
 
     print("Done")
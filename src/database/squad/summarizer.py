@@ -1,10 +1,6 @@
-import asyncio
-from uuid import uuid4
 from datasets import load_dataset, Dataset
 
-from helpers.dbscan import cluster
-from helpers.oai import async_gpt_calls, get_embeddings
-from helpers.pc import upsert_index
+from helpers.summarize import Adapter, summarize
 
 NEWLINE = "\n"
 
@@ -30,7 +26,7 @@ Statements:
 {statements}"""
 
 
-async def squad_summarize():
+def load_contexts():
     dataset = load_dataset("rajpurkar/squad", split="validation")
 
     data = dataset.select_columns(["id", "title", "context", "question"])
@@ -48,110 +44,13 @@ async def squad_summarize():
             raw_contexts.append(text)
         context_to_ids[text].append(id)
 
-    print("Getting statements...")
-
-    new_contexts = [
-        str(x).replace("\n- ", "\n").strip().removeprefix("- ")
-        for x in await async_gpt_calls(
-            [get_statement_prompt(context) for context in raw_contexts],
-            progress_bar=True,
-        )
-    ]
-
-    statements = [
-        {
-            "statement": statement.strip(),
-            "id": str(uuid4()),
-            "questions": context_to_ids[context],
-        }
-        for statement_list, context in zip(new_contexts, raw_contexts)
-        for statement in statement_list.split("\n")
-        if statement.strip() != ""
-    ]
-
-    statement_id_to_statement = {statement["id"]: statement for statement in statements}
-
-    print("Getting embeddings...")
-
-    embeddings = await get_embeddings(
-        [statement["statement"] for statement in statements], progress_bar=True
-    )
-
-    for statement, embedding in zip(statements, embeddings):
-        statement["vector"] = embedding.vector
-
-    print("Clustering embeddings...")
-
-    clusters = cluster(
-        [
-            {"vector": embedding.vector, "id": statement["id"]}
-            for embedding, statement in zip(embeddings, statements)
-        ],
-    )
-
-    print("Compressing clusters...")
-
-    no_compress = [cluster[0] for cluster in clusters if len(cluster) == 1]
-    to_compress = [cluster for cluster in clusters if len(cluster) > 1]
-
-    compressions = [
-        str(x)
-        for x in await async_gpt_calls(
-            [
-                get_compress_prompt(
-                    [
-                        statement_id_to_statement[statement_id]["statement"]
-                        for statement_id in cluster
-                    ]
-                )
-                for cluster in to_compress
-            ],
-            progress_bar=True,
-        )
-    ]
-
-    print("Updating embeddings...")
-
-    compression_embeddings = await get_embeddings(compressions, progress_bar=True)
-
-    print("Upserting embeddings...")
-
-    final_contexts = [
-        {
-            "id": statement_id_to_statement[statement_id]["id"],
-            "values": statement_id_to_statement[statement_id]["vector"],
-            "metadata": {
-                "content": statement_id_to_statement[statement_id]["statement"],
-                "ids": statement_id_to_statement[statement_id]["questions"],
-            },
-        }
-        for statement_id in no_compress
-    ]
-
-    final_contexts += [
-        {
-            "id": str(uuid4()),
-            "values": embedding.vector,
-            "metadata": {
-                "content": content,
-                "ids": list(
-                    set(
-                        [
-                            question
-                            for statement_id in statement_ids
-                            for question in statement_id_to_statement[statement_id][
-                                "questions"
-                            ]
-                        ]
-                    )
-                ),
-            },
-        }
-        for embedding, statement_ids, content in zip(
-            compression_embeddings, to_compress, compressions
-        )
-    ]
-
-    upsert_index("squad_summarized", final_contexts)
-
-    print("Done")
+    return context_to_ids
+
+
+adapter = Adapter(
+    "squad", load_contexts, get_statement_prompt, get_compress_prompt, "squad_summarized"
+)
+
+
+async def squad_summarize(incremental=False, stream=False):
+    await summarize(adapter, incremental, stream=stream)
@@ -0,0 +1,353 @@
+import asyncio
+import os
+from json import loads
+
+from openai.types import CompletionUsage
+from openai.types.create_embedding_response import Usage
+
+from helpers.data import TaskFailure, read_json, save_json
+from helpers.oai import (
+    BATCH_DIR,
+    DEFAULT_SYSTEM,
+    EmbeddingResponse,
+    GPTResponse,
+    asyncClient,
+    batch_embedding_call,
+    batch_gpt_call,
+    cache,
+    cached_response,
+    embedding_cache,
+    estimate_tokens,
+    get_messages,
+    request_key,
+)
+from helpers.usage import ledger
+from helpers.variables import SRC_DIR
+
+STATE_PATH = "temp/batches.json"
+
+# The API allows 50,000 requests (or embedding inputs) and 200 MB per batch
+# input file
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+
+FINAL_STATUSES = ["completed", "failed", "expired", "cancelled"]
+FAILED_STATUSES = ["failed", "expired", "cancelled"]
+
+
+class BatchManager:
+    def __init__(self):
+        try:
+            self.state: dict[str, dict] = read_json(STATE_PATH)
+        except (FileNotFoundError, ValueError):
+            self.state = {}
+
+    def save(self):
+        save_json(STATE_PATH, self.state)
+
+    def track(self, batch_id: str, name: str, kind: str):
+        self.state[batch_id] = {
+            "name": name,
+            "kind": kind,
+            "status": "validating",
+            "merged": False,
+        }
+        self.save()
+
+    def input_path(self, batch_id: str):
+        return SRC_DIR + BATCH_DIR + batch_id + ".input.jsonl"
+
+    def request_keys(self, batch_id: str) -> dict[str, str]:
+        """Maps the cache key of every request (or embedding input) in a batch to
+        its custom_id."""
+        keys = {}
+        for custom_id, request in self.requests(batch_id).items():
+            if self.state[batch_id]["kind"] == "embedding":
+                inputs = request["input"]
+                for text in [inputs] if isinstance(inputs, str) else inputs:
+                    keys[embedding_cache.key(text, request["model"])] = custom_id
+            else:
+                keys[
+                    request_key(
+                        request["model"], request["messages"], request.get("max_tokens")
+                    )
+                ] = custom_id
+        return keys
+
+    def find(self, keys: list[str]) -> dict[str, tuple[str, str]]:
+        """Maps each key already sent in a batch that has not been merged yet to
+        that batch and its custom_id, so reruns wait on it instead of resending."""
+        wanted = set(keys)
+        found: dict[str, tuple[str, str]] = {}
+        for batch_id, entry in self.state.items():
+            if (
+                entry["merged"]
+                or entry["status"] in FAILED_STATUSES
+                or not os.path.exists(self.input_path(batch_id))
+            ):
+                continue
+            for key, custom_id in self.request_keys(batch_id).items():
+                if key in wanted:
+                    found.setdefault(key, (batch_id, custom_id))
+        return found
+
+    def pending(self):
+        return [
+            batch_id for batch_id, entry in self.state.items() if not entry["merged"]
+        ]
+
+    async def status(self, batch_id: str):
+        batch = await asyncClient.batches.retrieve(batch_id)
+        entry = self.state.get(batch_id)
+        if entry is not None:
+            entry["status"] = batch.status
+            entry["output_file_id"] = batch.output_file_id
+            entry["error_file_id"] = batch.error_file_id
+            self.save()
+        return batch
+
+    async def poll(self, batch_id: str, interval=15.0, max_interval=300.0):
+        while True:
+            batch = await self.status(batch_id)
+            if batch.status in FINAL_STATUSES:
+                return batch
+            await asyncio.sleep(interval)
+            interval = min(max_interval, interval * 1.5)
+
+    async def download(self, file_id: str, path: str):
+        if os.path.exists(SRC_DIR + path):
+            return
+        async with asyncClient.files.with_streaming_response.content(
+            file_id
+        ) as response:
+            with open(SRC_DIR + path + ".part", "w") as f:
+                async for line in response.iter_lines():
+                    if line:
+                        f.write(line + "\n")
+        os.replace(SRC_DIR + path + ".part", SRC_DIR + path)
+
+    def requests(self, batch_id: str) -> dict[str, dict]:
+        requests = {}
+        with open(self.input_path(batch_id), "r") as f:
+            for line in f:
+                item = loads(line)
+                requests[item["custom_id"]] = item["body"]
+        return requests
+
+    def merge(self, kind: str, request: dict, item: dict, record: bool):
+        response = item.get("response") or {}
+        body = response.get("body") or {}
+
+        if item.get("error") or response.get("status_code") != 200:
+            return TaskFailure(
+                Exception(str(item.get("error") or body.get("error"))), 1
+            )
+
+        if kind == "embedding":
+            inputs = request["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            vectors = [
+                data["embedding"]
+                for data in sorted(body["data"], key=lambda data: data["index"])
+            ]
+            embedding_cache.add_many(list(zip(inputs, vectors)), request["model"])
+            if record:
+                ledger.record(
+                    request["model"], body["usage"]["total_tokens"], batch=True
+                )
+            # The vectors themselves are only kept in the embedding cache
+            return len(vectors)
+
+        message = body["choices"][0]["message"]
+        usage = CompletionUsage(**body["usage"])
+        if record:
+            ledger.record(
+                body["model"], usage.prompt_tokens, usage.completion_tokens, batch=True
+            )
+
+        # Refusals and empty completions are left uncached so they get retried
+        if not message.get("content"):
+            return TaskFailure(
+                Exception(message.get("refusal") or "Empty response from batch"), 1
+            )
+
+        cache.add(
+            request_key(
+                request["model"], request["messages"], request.get("max_tokens")
+            ),
+            message["content"],
+        )
+        return GPTResponse(message["content"], body["model"], usage)
+
+    async def results(self, batch_id: str) -> dict[str, object]:
+        """Waits for a batch, downloads its output and merges it into the caches."""
+        batch = await self.poll(batch_id)
+        entry = self.state[batch_id]
+        requests = self.requests(batch_id)
+        results: dict[str, object] = {}
+
+        for file_id, suffix in [
+            (batch.output_file_id, ".output.jsonl"),
+            (batch.error_file_id, ".errors.jsonl"),
+        ]:
+            if not file_id:
+                continue
+            path = BATCH_DIR + batch_id + suffix
+            await self.download(file_id, path)
+            with open(SRC_DIR + path, "r") as f:
+                for line in f:
+                    item = loads(line)
+                    if item["custom_id"] in requests:
+                        results[item["custom_id"]] = self.merge(
+                            entry["kind"],
+                            requests[item["custom_id"]],
+                            item,
+                            not entry["merged"],
+                        )
+
+        entry["merged"] = True
+        self.save()
+
+        return results
+
+    async def resume(self):
+        """Merges every tracked batch that has not been merged yet."""
+        return await asyncio.gather(
+            *[
+                self.results(batch_id)
+                for batch_id in self.pending()
+                # Batches created elsewhere have no input file to map results with
+                if os.path.exists(self.input_path(batch_id))
+            ]
+        )
+
+
+batches = BatchManager()
+
+
+def split_batches(sizes: list[int]) -> list[list[int]]:
+    """Groups request indices so each group fits in one batch input file."""
+    groups: list[list[int]] = []
+    total = 0
+    for i, size in enumerate(sizes):
+        if (
+            not groups
+            or len(groups[-1]) >= BATCH_MAX_REQUESTS
+            or total + size > BATCH_MAX_BYTES
+        ):
+            groups.append([])
+            total = 0
+        groups[-1].append(i)
+        total += size
+    return groups
+
+
+async def batch_gpt_calls(
+    prompts: list[str],
+    model="gpt-4o-mini",
+    system=DEFAULT_SYSTEM,
+    max_tokens: int | None = None,
+    batch_name="gpt",
+) -> list[GPTResponse | TaskFailure]:
+    """Like async_gpt_calls, but sends every uncached prompt through the Batch API."""
+    keys = [
+        request_key(model, get_messages(prompt, system), max_tokens)
+        for prompt in prompts
+    ]
+    results: list = [cache.get(key) for key in keys]
+    misses = [i for i, result in enumerate(results) if not result]
+
+    for i, result in enumerate(results):
+        if result:
+            results[i] = cached_response(result, model, get_messages(prompts[i], system))
+
+    if not misses:
+        return results
+
+    # Requests already sent by an earlier run are waited on rather than resent
+    found = batches.find([keys[i] for i in misses])
+    unsent = [i for i in misses if keys[i] not in found]
+
+    async def wait(batch_id: str):
+        responses = await batches.results(batch_id)
+
+        for i in misses:
+            if keys[i] in found and found[keys[i]][0] == batch_id:
+                results[i] = responses.get(
+                    found[keys[i]][1],
+                    TaskFailure(Exception("Missing from batch output"), 1),
+                )
+
+    async def run(group: list[int]):
+        batch_id = await asyncio.to_thread(
+            batch_gpt_call,
+            batch_name,
+            [prompts[i] for i in group],
+            model,
+            system,
+            max_tokens,
+        )
+
+        responses = await batches.results(batch_id)
+
+        for j, i in enumerate(group):
+            results[i] = responses.get(
+                str(j), TaskFailure(Exception("Missing from batch output"), 1)
+            )
+
+    # Each line carries the prompt plus roughly 200 bytes of JSON around it
+    sizes = [len((system + prompts[i]).encode()) + 200 for i in unsent]
+
+    await asyncio.gather(
+        *[wait(batch_id) for batch_id in {b for b, _ in found.values()}],
+        *[run([unsent[j] for j in group]) for group in split_batches(sizes)],
+    )
+
+    return results
+
+
+async def batch_embeddings(
+    texts: list[str], model="text-embedding-3-large", batch_name="embeddings"
+) -> list[EmbeddingResponse]:
+    """Like get_embeddings, but sends every uncached text through the Batch API."""
+    misses: list[str] = []
+    for text in dict.fromkeys(texts):
+        if embedding_cache.get(text, model) is None:
+            misses.append(text)
+        else:
+            ledger.record_cached(model, estimate_tokens(text, model))
+
+    # Texts already sent by an earlier run are waited on rather than resent
+    found = batches.find([embedding_cache.key(text, model) for text in misses])
+    unsent = [text for text in misses if embedding_cache.key(text, model) not in found]
+
+    async def run(group: list[str]):
+        batch_id = await asyncio.to_thread(
+            batch_embedding_call, batch_name, group, model
+        )
+
+        await batches.results(batch_id)
+
+    # Each input costs its text plus a few bytes of JSON quoting
+    sizes = [len(text.encode()) + 8 for text in unsent]
+
+    await asyncio.gather(
+        *[batches.results(batch_id) for batch_id in {b for b, _ in found.values()}],
+        *[run([unsent[i] for i in group]) for group in split_batches(sizes)],
+    )
+
+    results: list[EmbeddingResponse] = []
+
+    for text in texts:
+        vector = embedding_cache.get(text, model)
+        if vector is None:
+            raise Exception("Error getting embeddings")
+        tokens = estimate_tokens(text, model)
+        results.append(
+            EmbeddingResponse(
+                vector, model, Usage(prompt_tokens=tokens, total_tokens=tokens)
+            )
+        )
+
+    return results
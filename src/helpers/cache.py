@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from json import load
+
+from helpers.variables import SRC_DIR
+
+
+class LRUCache:
+    def __init__(self, max_size=10_000, ttl: float | None = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        created, value = item
+        if self.ttl is not None and time.time() - created > self.ttl:
+            del self.items[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def add(self, key: str, value, created: float | None = None):
+        self.items[key] = (created or time.time(), value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.items),
+        }
+
+    def __len__(self):
+        return len(self.items)
+
+
+class DiskCache:
+    def __init__(
+        self,
+        path: str,
+        table="cache",
+        max_memory_items=10_000,
+        ttl: float | None = None,
+    ):
+        full_path = os.path.join(SRC_DIR, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self.memory = LRUCache(max_memory_items, ttl)
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(
+            full_path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value, created REAL)"
+        )
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        row = self.connection.execute(
+            f"SELECT value, created FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None or (
+            self.ttl is not None and time.time() - (row[1] or 0) > self.ttl
+        ):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.memory.add(key, row[0], row[1])
+        return row[0]
+
+    def add(self, key: str, value):
+        created = time.time()
+        self.memory.add(key, value, created)
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+            (key, value, created),
+        )
+
+    def add_many(self, items: list[tuple[str, object]]):
+        created = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created) VALUES (?, ?, ?)",
+                [(key, value, created) for key, value in items],
+            )
+
+    def expire(self):
+        if self.ttl is None:
+            return 0
+        return self.connection.execute(
+            f"DELETE FROM {self.table} WHERE created < ?", (time.time() - self.ttl,)
+        ).rowcount
+
+    def clear(self):
+        self.memory.clear()
+        self.connection.execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        self.connection.close()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory.hits,
+            "evictions": self.memory.evictions,
+            "memory_size": len(self.memory),
+        }
+
+    def __len__(self):
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[
+            0
+        ]
+
+
+def migrate_json(
+    path: str, cache: DiskCache, key: Callable[[str], str] = lambda key: key
+):
+    """Moves a legacy JSON cache file into `cache` and renames the file."""
+    full_path = os.path.join(SRC_DIR, path)
+    if not os.path.exists(full_path):
+        return 0
+
+    try:
+        with open(full_path, "r") as f:
+            data = load(f)
+    except ValueError:
+        data = {}
+
+    cache.add_many([(key(old_key), value) for old_key, value in data.items()])
+    os.replace(full_path, full_path + ".migrated")
+
+    return len(data)
+
+
+def migrate_table(
+    table: str, cache: DiskCache, key: Callable[[str], str] = lambda key: key
+):
+    """Moves a legacy table in the same database into `cache` and drops it."""
+    exists = cache.connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if not exists:
+        return 0
+
+    rows = cache.connection.execute(f"SELECT key, value FROM {table}").fetchall()
+    cache.add_many([(key(old_key), value) for old_key, value in rows])
+    cache.connection.execute(f"DROP TABLE {table}")
+
+    return len(rows)
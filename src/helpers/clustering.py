@@ -0,0 +1,213 @@
+from collections.abc import Iterator
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Size of the distance block computed at once by the exact neighbor search
+BLOCK_MEMORY = 256 * 1024 * 1024
+
+# Above this many points (and with hnswlib installed) neighbors come from an
+# HNSW graph instead of the exact blocked search
+HNSW_THRESHOLD = 50_000
+HNSW_NEIGHBORS = 32
+
+
+def merge_components(components: np.ndarray, rows: np.ndarray, cols: np.ndarray):
+    """Relabels `components` (a component label per point) so that every
+    (rows[k], cols[k]) pair ends up in the same component."""
+    if not len(rows):
+        return components
+    n = len(components)
+    graph = coo_matrix(
+        (np.ones(len(rows), dtype=np.int8), (components[rows], components[cols])),
+        shape=(n, n),
+    )
+    _, merged = connected_components(graph, directed=False)
+    return merged[components]
+
+
+def standardize(data: np.ndarray):
+    """Returns the columns scaled to zero mean and unit variance, like StandardScaler."""
+    mean = data.mean(axis=0, dtype=np.float64)
+    std = data.std(axis=0, dtype=np.float64)
+    std[std == 0] = 1
+    data = data - mean.astype(data.dtype)
+    data /= std.astype(data.dtype)
+    return data
+
+
+class Neighborhoods:
+    """Pairs of points within `eps` (Euclidean) of each other, a block at a time.
+
+    Iterating yields (rows, cols) index arrays with cols[k] a neighbor of
+    rows[k]. The exact search lists every pair in both directions; the HNSW
+    search lists each point's nearest HNSW_NEIGHBORS that fall within `eps`.
+    Memory stays bounded by BLOCK_MEMORY or the neighbor count per point.
+    """
+
+    def __init__(self, data: np.ndarray, eps: float, exact: bool | None = None):
+        self.data = data
+        self.eps = eps
+        if exact is None:
+            exact = hnswlib is None or len(data) <= HNSW_THRESHOLD
+        self.exact = exact
+        self.symmetric = exact
+        self.graph = None
+
+    def __iter__(self) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        if self.exact:
+            return self.exact_blocks()
+        return self.graph_blocks()
+
+    def exact_blocks(self):
+        n = len(self.data)
+        squares = np.einsum("ij,ij->i", self.data, self.data)
+        block_size = max(1, min(n, BLOCK_MEMORY // (4 * max(n, 1))))
+        limit = self.eps * self.eps
+
+        for start in range(0, n, block_size):
+            block = self.data[start : start + block_size]
+            distances = block @ self.data.T
+            distances *= -2
+            distances += squares[start : start + block_size, None]
+            distances += squares[None, :]
+            rows, cols = np.nonzero(distances <= limit)
+            rows += start
+            keep = rows != cols
+            yield rows[keep], cols[keep]
+
+    def graph_blocks(self):
+        n = len(self.data)
+        k = min(n, HNSW_NEIGHBORS + 1)
+
+        if self.graph is None:
+            graph = hnswlib.Index(space="l2", dim=self.data.shape[1])  # type: ignore
+            graph.init_index(max_elements=n, ef_construction=200, M=16)
+            graph.add_items(self.data, np.arange(n))
+            graph.set_ef(max(64, k * 2))
+            self.graph = graph
+
+        # hnswlib's l2 space returns squared distances
+        limit = self.eps * self.eps
+        block_size = 10_000
+
+        for start in range(0, n, block_size):
+            labels, distances = self.graph.knn_query(
+                self.data[start : start + block_size], k=k
+            )
+            rows = np.repeat(np.arange(start, start + len(labels)), k)
+            cols = labels.reshape(-1).astype(np.int64)
+            keep = (distances.reshape(-1) <= limit) & (rows != cols)
+            yield rows[keep], cols[keep]
+
+
+def dbscan(
+    data: np.ndarray, eps: float, min_samples=1, exact: bool | None = None
+) -> np.ndarray:
+    """DBSCAN labels (-1 for noise) from connected components of the eps-graph.
+
+    Core points (at least `min_samples` points within `eps`, counting
+    themselves) are joined through core-to-core edges, and every other point
+    within `eps` of a core point joins that core point's cluster.
+    """
+    n = len(data)
+    neighborhoods = Neighborhoods(data, eps, exact)
+    components = np.arange(n)
+
+    def forward(rows: np.ndarray, cols: np.ndarray):
+        # Symmetric searches list each edge twice and only one copy is needed
+        if neighborhoods.symmetric:
+            return rows < cols
+        return np.ones(len(rows), dtype=bool)
+
+    if min_samples <= 1:
+        # Every point is a core point, so each block's edges merge right away
+        for rows, cols in neighborhoods:
+            keep = forward(rows, cols)
+            components = merge_components(components, rows[keep], cols[keep])
+        return components
+
+    # Core points are only known once every neighbor is counted, so the edges
+    # are kept from the same pass instead of searching twice
+    counts = np.ones(n, dtype=np.int64)
+    edge_rows: list[np.ndarray] = []
+    edge_cols: list[np.ndarray] = []
+    for rows, cols in neighborhoods:
+        counts += np.bincount(rows, minlength=n)
+        keep = forward(rows, cols)
+        edge_rows.append(rows[keep].astype(np.int32))
+        edge_cols.append(cols[keep].astype(np.int32))
+
+    rows = np.concatenate(edge_rows) if edge_rows else np.zeros(0, dtype=np.int32)
+    cols = np.concatenate(edge_cols) if edge_cols else np.zeros(0, dtype=np.int32)
+    core = counts >= min_samples
+
+    both = core[rows] & core[cols]
+    components = merge_components(components, rows[both], cols[both])
+
+    # Edges are listed once, so border points can be on either end
+    border = np.full(n, -1)
+    for a, b in [(cols, rows), (rows, cols)]:
+        reached = ~core[a] & core[b]
+        border[a[reached]] = b[reached]
+
+    labels = np.where(core, components, -1)
+    reached = ~core & (border != -1)
+    labels[reached] = components[border[reached]]
+
+    return labels
+
+
+def normalize(data: np.ndarray):
+    """Returns the rows scaled to unit length, or `data` itself if they already are."""
+    norms = np.linalg.norm(data, axis=1)
+    if not np.allclose(norms, 1, atol=1e-3):
+        norms[norms == 0] = 1
+        data = data / norms[:, None].astype(data.dtype)
+    return data
+
+
+def random_projection(data: np.ndarray, dimensions: int, seed=0):
+    """Projects rows onto `dimensions` Gaussian directions, which roughly preserves angles."""
+    matrix = np.random.default_rng(seed).standard_normal(
+        (data.shape[1], dimensions), dtype=np.float32
+    )
+    return normalize(data @ matrix)
+
+
+def pca(data: np.ndarray, dimensions: int, block_size=10_000):
+    """Projects rows onto their top `dimensions` principal components, a block at a time."""
+    mean = data.mean(axis=0, dtype=np.float64).astype(np.float32)
+    covariance = np.zeros((data.shape[1], data.shape[1]), dtype=np.float64)
+
+    for start in range(0, len(data), block_size):
+        block = data[start : start + block_size] - mean
+        covariance += block.T @ block
+
+    _, vectors = np.linalg.eigh(covariance)
+    components = np.ascontiguousarray(vectors[:, ::-1][:, :dimensions], np.float32)
+
+    result = np.empty((len(data), dimensions), dtype=np.float32)
+    for start in range(0, len(data), block_size):
+        result[start : start + block_size] = (
+            data[start : start + block_size] - mean
+        ) @ components
+
+    return normalize(result)
+
+
+def cosine_dbscan(
+    data: np.ndarray, threshold: float, min_samples=1, exact: bool | None = None
+):
+    """DBSCAN over unit-length rows, linking pairs with cosine similarity >= threshold.
+
+    For unit vectors |a - b|^2 = 2 - 2 a.b, so this is the Euclidean search
+    with eps = sqrt(2 - 2 * threshold) and needs no rescaling of the data.
+    """
+    return dbscan(data, float(np.sqrt(max(0.0, 2 - 2 * threshold))), min_samples, exact)
@@ -1,10 +1,12 @@
 import asyncio
-from collections.abc import Callable, Coroutine
+from collections.abc import AsyncIterable, AsyncIterator, Callable, Coroutine, Iterable
 from json import load, loads, dump, dumps
 import os
+import random
 import re
 from typing import Any
 
+from helpers.limiter import AdaptiveLimiter, CircuitBreaker
 from helpers.variables import SRC_DIR
 
 
@@ -55,30 +57,132 @@ def get_number(string: str) -> str:
     return re.findall(r"[-+]?\d*\.\d+|\d+", string)[-1]
 
 
-async def queue(data: list[Callable[[], Coroutine[Any, Any, Any]]], max_concurrent=80):
-    async def worker(queue: asyncio.Queue, results):
-        while True:
-            index, func = await queue.get()
-            try:
-                results[index] = await func()
-            finally:
-                queue.task_done()
+Job = Callable[[], Coroutine[Any, Any, Any]]
 
-    queue = asyncio.Queue()
-    results: list = [None] * len(data)
 
-    for index, func in enumerate(data):
-        await queue.put((index, func))
+class TaskFailure:
+    """Takes the place of a result whose task raised on every attempt."""
+
+    def __init__(self, error: Exception, attempts: int):
+        self.error = error
+        self.attempts = attempts
+
+    def __bool__(self):
+        return False
+
+    def __str__(self):
+        return ""
+
+    def __repr__(self):
+        return f"TaskFailure({self.error!r}, attempts={self.attempts})"
+
 
-    workers = [
-        asyncio.create_task(worker(queue, results)) for _ in range(max_concurrent)
-    ]
+async def iterate(data: Iterable | AsyncIterable):
+    if isinstance(data, AsyncIterable):
+        async for item in data:
+            yield item
+    else:
+        for item in data:
+            yield item
 
-    await queue.join()
 
-    for w in workers:
-        w.cancel()
+async def stream_queue(
+    data: Iterable[Job] | AsyncIterable[Job],
+    max_concurrent=80,
+    limiter: AdaptiveLimiter | None = None,
+    weights: list[float] | None = None,
+    retries=0,
+    backoff=1.0,
+    max_backoff=30.0,
+    breaker: CircuitBreaker | None = None,
+) -> AsyncIterator[tuple[int, Any]]:
+    """Yields (index, result) pairs as tasks finish, pulling work lazily from `data`.
+
+    Failed tasks are retried with exponential backoff and full jitter, and
+    yield a `TaskFailure` once they run out of retries.
+    """
+
+    async def call(index: int, func: Job):
+        if limiter:
+            async with limiter.slot(weights[index] if weights else 0):
+                return await func()
+        return await func()
+
+    async def run(index: int, func: Job):
+        attempts = 0
+        while True:
+            attempts += 1
+            if breaker:
+                await breaker.wait()
+            try:
+                result = await call(index, func)
+            except Exception as e:
+                if breaker:
+                    breaker.record_failure()
+                if attempts > retries:
+                    return index, TaskFailure(e, attempts)
+                await asyncio.sleep(
+                    random.uniform(0, min(max_backoff, backoff * 2 ** (attempts - 1)))
+                )
+            else:
+                if breaker:
+                    breaker.record_success()
+                return index, result
+
+    if limiter:
+        max_concurrent = limiter.max_concurrent
+
+    items = iterate(data)
+    pending: set[asyncio.Task] = set()
+    next_item: asyncio.Task | None = None
+    exhausted = False
+    index = 0
+
+    try:
+        while True:
+            if not exhausted and next_item is None and len(pending) < max_concurrent:
+                next_item = asyncio.ensure_future(anext(items))
+
+            waiting = pending | {next_item} if next_item else pending
+            if not waiting:
+                return
+
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if next_item in done:
+                try:
+                    pending.add(asyncio.create_task(run(index, next_item.result())))
+                    index += 1
+                except StopAsyncIteration:
+                    exhausted = True
+                next_item = None
+
+            for task in done & pending:
+                pending.remove(task)
+                yield task.result()
+    finally:
+        leftover = pending | ({next_item} if next_item else set())
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+        await items.aclose()
+
+
+async def queue(
+    data: list[Job],
+    max_concurrent=80,
+    limiter: AdaptiveLimiter | None = None,
+    weights: list[float] | None = None,
+    retries=0,
+    backoff=1.0,
+    max_backoff=30.0,
+    breaker: CircuitBreaker | None = None,
+):
+    results: list = [None] * len(data)
 
-    await asyncio.gather(*workers, return_exceptions=True)
+    async for index, result in stream_queue(
+        data, max_concurrent, limiter, weights, retries, backoff, max_backoff, breaker
+    ):
+        results[index] = result
 
     return results
@@ -1,7 +1,17 @@
-from typing import TypedDict
+from typing import Literal, TypedDict
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import DBSCAN
+
+from helpers.clustering import (
+    cosine_dbscan,
+    dbscan,
+    normalize,
+    pca,
+    random_projection,
+    standardize,
+)
+
+# Cosine similarity above which two statements are linked in "cosine" mode
+COSINE_THRESHOLD = 0.9
 
 
 class Vector(TypedDict):
@@ -9,13 +19,65 @@ class Vector(TypedDict):
     id: str
 
 
-def cluster(vectors: list[Vector], eps=45.0, min_samples=1) -> list[list[str]]:
-    data = StandardScaler().fit_transform(
-        np.array([vector["vector"] for vector in vectors])
+def cluster(
+    vectors: list[Vector],
+    eps=45.0,
+    min_samples=1,
+    metric: Literal["euclidean", "cosine"] = "euclidean",
+    threshold=COSINE_THRESHOLD,
+    dimensions: int | None = None,
+    reduction: Literal["random", "pca"] = "random",
+) -> list[list[str]]:
+    if not vectors:
+        return []
+    return cluster_matrix(
+        np.array([vector["vector"] for vector in vectors], dtype=np.float32),
+        [vector["id"] for vector in vectors],
+        eps,
+        min_samples,
+        metric,
+        threshold,
+        dimensions,
+        reduction,
     )
-    db = DBSCAN(eps=eps, min_samples=min_samples, metric="euclidean").fit(data)
-    clusters: dict[str, list[str]] = {}
-    for item, label in zip(vectors, db.labels_):
-        clusters.setdefault(label, []).append(item["id"])
+
+
+def cluster_matrix(
+    data: np.ndarray,
+    ids: list[str],
+    eps=45.0,
+    min_samples=1,
+    metric: Literal["euclidean", "cosine"] = "euclidean",
+    threshold=COSINE_THRESHOLD,
+    dimensions: int | None = None,
+    reduction: Literal["random", "pca"] = "random",
+) -> list[list[str]]:
+    """Clusters the rows of an (n, d) matrix and returns their IDs grouped.
+
+    "euclidean" standardises the columns and uses `eps`, as sklearn's
+    StandardScaler + DBSCAN did. "cosine" links rows whose similarity is at
+    least `threshold` and uses a float32 matrix as is (OpenAI embeddings are
+    already unit length). `data` itself is never modified, and `dimensions`
+    first reduces the data with a random projection or PCA.
+    """
+    if not len(ids):
+        return []
+
+    data = np.asarray(data, dtype=np.float32)
+
+    if metric == "cosine":
+        data = normalize(data)
+        if dimensions:
+            data = (pca if reduction == "pca" else random_projection)(data, dimensions)
+        labels = cosine_dbscan(data, threshold, min_samples)
+    else:
+        data = standardize(data)
+        if dimensions:
+            data = (pca if reduction == "pca" else random_projection)(data, dimensions)
+        labels = dbscan(data, eps, min_samples)
+
+    clusters: dict[int, list[str]] = {}
+    for id, label in zip(ids, labels):
+        clusters.setdefault(label, []).append(id)
     formatted_clusters = [vectors for label, vectors in clusters.items() if label != -1]
     return formatted_clusters
@@ -0,0 +1,132 @@
+import mmap
+import os
+import shutil
+import threading
+from collections.abc import Iterable
+from json import dumps, loads
+
+from helpers.variables import SRC_DIR
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DOCSTORE_DIR = "temp/docs/"
+
+
+class DocStore:
+    """Passage text and question IDs for one namespace, looked up by vector ID.
+
+    Records are appended to data.bin (zstd-compressed when zstandard is
+    installed) and read back through a memory map using the offsets in
+    index.jsonl. The last entry for an ID wins.
+    """
+
+    def __init__(self, path: str, compress: bool | None = None):
+        self.path = SRC_DIR + path
+        self.lock = threading.Lock()
+        self.offsets: dict[str, tuple[int, int]] = {}
+        self.map: mmap.mmap | None = None
+
+        os.makedirs(self.path, exist_ok=True)
+
+        if os.path.exists(self.path + "docstore.json"):
+            with open(self.path + "docstore.json", "r") as f:
+                self.compression = loads(f.read())["compression"]
+        else:
+            if compress is None:
+                compress = zstandard is not None
+            self.compression = "zstd" if compress else None
+            with open(self.path + "docstore.json", "w") as f:
+                f.write(dumps({"compression": self.compression}))
+
+        if self.compression == "zstd" and zstandard is None:
+            raise Exception("zstandard is required to read " + path)
+
+        if os.path.exists(self.path + "index.jsonl"):
+            with open(self.path + "index.jsonl", "r") as f:
+                for line in f:
+                    item = loads(line)
+                    self.offsets[item["id"]] = (item["offset"], item["length"])
+
+    def encode(self, doc: dict):
+        data = dumps(doc).encode()
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)  # type: ignore
+        return data
+
+    def decode(self, data: bytes) -> dict:
+        if self.compression == "zstd":
+            data = zstandard.ZstdDecompressor().decompress(data)  # type: ignore
+        return loads(data)
+
+    def add_many(self, docs: Iterable[tuple[str, dict]]):
+        records = [(id, self.encode(doc)) for id, doc in docs]
+        if not records:
+            return
+
+        with self.lock:
+            lines = []
+            with open(self.path + "data.bin", "ab") as f:
+                offset = f.tell()
+                for id, data in records:
+                    f.write(data)
+                    self.offsets[id] = (offset, len(data))
+                    lines.append(
+                        dumps({"id": id, "offset": offset, "length": len(data)}) + "\n"
+                    )
+                    offset += len(data)
+            with open(self.path + "index.jsonl", "a") as f:
+                f.writelines(lines)
+
+    def read(self, offset: int, length: int):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                if self.map is not None:
+                    self.map.close()
+                with open(self.path + "data.bin", "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset : offset + length]
+
+    def get(self, id: str) -> dict | None:
+        location = self.offsets.get(id)
+        if location is None:
+            return None
+        return self.decode(self.read(*location))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+docstores: dict[str, DocStore] = {}
+# Upserts call get_docstore from many executor threads, and two DocStores on
+# one namespace would append to data.bin with different offsets
+docstores_lock = threading.Lock()
+
+
+def get_docstore(namespace: str, create=True):
+    """Returns the namespace's docstore, or None if it has none and `create` is False."""
+    if namespace in docstores:
+        return docstores[namespace]
+    with docstores_lock:
+        if namespace not in docstores:
+            path = DOCSTORE_DIR + namespace + "/"
+            if not create and not os.path.exists(SRC_DIR + path + "docstore.json"):
+                return None
+            docstores[namespace] = DocStore(path)
+        return docstores[namespace]
+
+
+def remove_docstore(namespace: str):
+    """Deletes the namespace's docstore from disk."""
+    with docstores_lock:
+        docs = docstores.pop(namespace, None)
+        if docs is not None:
+            docs.close()
+        shutil.rmtree(SRC_DIR + DOCSTORE_DIR + namespace + "/", ignore_errors=True)
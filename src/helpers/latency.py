@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+
+class LatencyHistogram:
+    def __init__(self, size=500, min_samples=20):
+        self.samples: deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, percent: float) -> float | None:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+latencies: dict[str, LatencyHistogram] = {}
+
+
+def get_latency(name: str):
+    if name not in latencies:
+        latencies[name] = LatencyHistogram()
+    return latencies[name]
+
+
+class HedgeBudget:
+    def __init__(self, ratio=0.1):
+        self.ratio = ratio
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def allow(self):
+        return self.hedges + 1 <= self.ratio * self.calls
+
+    def stats(self):
+        return {"calls": self.calls, "hedges": self.hedges, "wins": self.wins}
+
+
+async def timed(request: Callable[[], Awaitable[Any]], histogram: LatencyHistogram):
+    """Awaits `request` and records how long it took if it completes."""
+    start = time.monotonic()
+    result = await request()
+    histogram.record(time.monotonic() - start)
+    return result
+
+
+async def hedged(
+    request: Callable[[], Awaitable[Any]],
+    histogram: LatencyHistogram,
+    budget: HedgeBudget,
+    percentile=95.0,
+    timeout=60.0,
+):
+    """Runs `request`, sending a duplicate if it outlives the histogram's percentile.
+
+    Whichever copy succeeds first wins and the other is cancelled. One sample
+    is recorded per call: the winning copy's latency, or `timeout` if the call
+    timed out.
+    """
+    budget.calls += 1
+    delay = histogram.percentile(percentile)
+    starts: dict[asyncio.Future, float] = {}
+
+    def attempt():
+        task = asyncio.ensure_future(request())
+        starts[task] = time.monotonic()
+        return task
+
+    async def race():
+        first = attempt()
+        tasks = {first}
+        try:
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not first.done() and budget.allow():
+                    budget.hedges += 1
+                    tasks.add(attempt())
+
+            error: BaseException | None = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        histogram.record(time.monotonic() - starts[task])
+                        if task is not first:
+                            budget.wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error  # type: ignore
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    try:
+        return await asyncio.wait_for(race(), timeout)
+    except asyncio.TimeoutError:
+        histogram.record(timeout)
+        raise
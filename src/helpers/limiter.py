@@ -0,0 +1,189 @@
+import asyncio
+import time
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+
+# Rate limits and timeouts both mean the API is taking more than it can handle
+CONGESTION_ERRORS = ("RateLimitError", "APITimeoutError", "TimeoutError")
+
+
+def is_congestion_error(error: BaseException | None):
+    """Whether an error (or anything it was raised from) is a 429 or a timeout."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if (
+            type(error).__name__ in CONGESTION_ERRORS
+            or getattr(error, "status_code", None) == 429
+        ):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class RateBudget:
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock: asyncio.Lock | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.per_minute)
+        if self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.lock = asyncio.Lock()
+        async with self.lock:  # type: ignore
+            while True:
+                now = time.monotonic()
+                self.available = min(
+                    self.per_minute,
+                    self.available + (now - self.updated) * self.per_minute / 60,
+                )
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) * 60 / self.per_minute)
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit with optional request and token per-minute budgets.
+
+    The limit starts at `initial` (or `max_concurrent`), is multiplied by
+    `decrease` on 429s and timeouts (and on latency above `latency_target`,
+    if one is set) and otherwise grows by `increase` per window of
+    successful calls, up to `max_concurrent`. `latency_target` can be a
+    callable, for a target that follows recent latencies.
+    """
+
+    def __init__(
+        self,
+        max_concurrent=80,
+        min_concurrent=1,
+        initial: int | None = None,
+        requests_per_minute: float | None = None,
+        tokens_per_minute: float | None = None,
+        latency_target: float | Callable[[], float | None] | None = None,
+        increase=1.0,
+        decrease=0.5,
+    ):
+        self.max_concurrent = max_concurrent
+        self.min_concurrent = min_concurrent
+        self.limit = float(initial or max_concurrent)
+        self.requests = RateBudget(requests_per_minute) if requests_per_minute else None
+        self.tokens = RateBudget(tokens_per_minute) if tokens_per_minute else None
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self.latency: float | None = None
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.errors = 0
+        self.condition = asyncio.Condition()
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+    def is_slow(self, latency: float):
+        target = self.latency_target
+        if callable(target):
+            target = target()
+        return target is not None and latency > target
+
+    def on_success(self, latency: float):
+        self.successes += 1
+        self.latency = (
+            latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+        )
+        if self.is_slow(latency):
+            self.back_off()
+        else:
+            self.limit = min(
+                self.max_concurrent, self.limit + self.increase / max(self.limit, 1)
+            )
+
+    def on_error(self, error: BaseException):
+        self.errors += 1
+        if is_congestion_error(error):
+            self.back_off()
+
+    def back_off(self):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 1):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_concurrent, self.limit * self.decrease)
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "successes": self.successes,
+            "errors": self.errors,
+        }
+
+    @asynccontextmanager
+    async def slot(self, tokens: float = 0):
+        if self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.condition = asyncio.Condition()
+            self.in_flight = 0
+
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < max(self.min_concurrent, int(self.limit))
+            )
+            self.in_flight += 1
+
+        try:
+            if self.requests:
+                await self.requests.acquire(1)
+            if self.tokens and tokens:
+                await self.tokens.acquire(tokens)
+
+            start = time.monotonic()
+            try:
+                yield
+            except Exception as e:
+                self.on_error(e)
+                raise
+            self.on_success(time.monotonic() - start)
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+
+class CircuitBreaker:
+    """Pauses new attempts for `cooldown` seconds after `threshold` failures in a row."""
+
+    def __init__(self, threshold=10, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trips = 0
+
+    def is_open(self):
+        return (
+            self.opened_at is not None
+            and time.monotonic() - self.opened_at < self.cooldown
+        )
+
+    async def wait(self):
+        while self.is_open():
+            await asyncio.sleep(
+                self.cooldown - (time.monotonic() - (self.opened_at or 0))
+            )
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold and not self.is_open():
+            self.opened_at = time.monotonic()
+            self.trips += 1
@@ -1,27 +1,35 @@
+import asyncio
 from functools import partial
+from hashlib import sha256
+from json import load
 from math import ceil
+import numpy as np
 from openai import AsyncOpenAI, OpenAI
 from openai.types import CompletionUsage
 from openai.types.create_embedding_response import Usage
 import os
 from dotenv import load_dotenv
+from collections.abc import Iterable
+from typing import Literal
 from uuid import uuid4
-import asyncio
 
+from helpers.cache import DiskCache, migrate_json, migrate_table
 from helpers.data import (
     add_to_file,
     chunk_list,
-    delete_file,
     queue,
     read_json,
-    save_file,
-    save_json,
+    stream_queue,
+    TaskFailure,
     stringify,
 )
+from helpers.latency import HedgeBudget, get_latency, hedged
+from helpers.limiter import AdaptiveLimiter, CircuitBreaker
 from helpers.progress import Progress
+from helpers.usage import count_tokens, get_cost, ledger
 from helpers.variables import SRC_DIR
-from helpers.data import queue
 import atexit
+import time
 
 load_dotenv()
 client = OpenAI()
@@ -35,25 +43,45 @@ if not OPENAI_API_KEY:
 client.api_key = OPENAI_API_KEY
 asyncClient.api_key = OPENAI_API_KEY
 
-# Per 1 Million Tokens
-prices = {
-    "gpt-4o": {"input": 2.5, "output": 10},
-    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
-    "text-embedding-3-small": 0.02,
-    "text-embedding-3-large": 0.13,
-}
+# Per minute, for the account's usage tier. "concurrency" is where each
+# model's limiter starts and "max_concurrency" how far it may grow
+if os.getenv("RATE_LIMITS_PATH"):
+    with open(os.getenv("RATE_LIMITS_PATH", ""), "r") as f:
+        rate_limits: dict[str, dict] = load(f)
+else:
+    rate_limits = read_json("rate_limits.json")
+
+limiters: dict[str, AdaptiveLimiter] = {}
+breakers: dict[str, CircuitBreaker] = {}
+hedge_budgets: dict[str, HedgeBudget] = {}
+
+# A duplicate request is sent once a call outlives this percentile of recent
+# latencies for its model, for at most HEDGE_RATIO of calls
+HEDGE_PERCENTILE = 95.0
+HEDGE_RATIO = 0.1
+REQUEST_TIMEOUT = 60.0
+
+# The limiter backs off when a call takes this many times the model's recent
+# median latency
+LATENCY_TARGET_FACTOR = 3.0
+
+# Workloads at least this large use the Batch API in "auto" mode for whatever
+# the caller's latency budget can't cover in realtime
+BATCH_THRESHOLD = 10_000
+BATCH_WINDOW = 24 * 60 * 60
 
 DEFAULT_SYSTEM = ""
 
+CACHE_MEMORY_SIZE = 10_000
+EMBEDDING_CACHE_MEMORY_SIZE = 2_000
+CACHE_TTL: float | None = None
+
 # if not os.path.exists(SRC_DIR + "../running-batches.txt"):
 #     save_file(SRC_DIR + "../running-batches.txt", "")
 
 if not os.path.exists(SRC_DIR + "temp"):
     os.makedirs(SRC_DIR + "temp")
 
-if not os.path.exists(SRC_DIR + "temp/gpt-cache.json"):
-    save_json("temp/gpt-cache.json", {})
-
 
 class GPTResponse:
     def __init__(self, content: str, model: str, usage: CompletionUsage):
@@ -65,36 +93,153 @@ class GPTResponse:
         return self.content
 
     def get_cost(self):
-        return (
-            self.usage.completion_tokens * prices[self.model]["output"]
-            + self.usage.prompt_tokens * prices[self.model]["input"]
+        return get_cost(
+            self.model, self.usage.prompt_tokens, self.usage.completion_tokens
         )
 
 
+def get_limiter(model: str):
+    if model not in limiters:
+        limits = rate_limits.get(model, {})
+        concurrency = limits.get("concurrency", 20)
+
+        def latency_target():
+            median = get_latency(model).percentile(50)
+            return median * LATENCY_TARGET_FACTOR if median is not None else None
+
+        limiters[model] = AdaptiveLimiter(
+            limits.get("max_concurrency", concurrency * 4),
+            initial=concurrency,
+            requests_per_minute=limits.get("requests"),
+            tokens_per_minute=limits.get("tokens"),
+            latency_target=latency_target,
+        )
+    return limiters[model]
+
+
+def get_breaker(model: str):
+    if model not in breakers:
+        breakers[model] = CircuitBreaker()
+    return breakers[model]
+
+
+def get_hedge_budget(model: str):
+    if model not in hedge_budgets:
+        hedge_budgets[model] = HedgeBudget(HEDGE_RATIO)
+    return hedge_budgets[model]
+
+
+def estimate_tokens(text: str, model="gpt-4o-mini"):
+    return count_tokens(text, model)
+
+
+def get_messages(prompt: str, system=DEFAULT_SYSTEM):
+    messages = []
+    if system:
+        messages.append({"role": "system", "content": system})
+
+    messages.append({"role": "user", "content": prompt})
+
+    return messages
+
+
+def request_key(model: str, messages: list[dict], max_tokens: int | None = None):
+    return sha256(
+        stringify(
+            {"model": model, "messages": messages, "max_tokens": max_tokens}
+        ).encode()
+    ).hexdigest()
+
+
+def legacy_key(prompt: str):
+    """Key for an entry from the old prompt-keyed caches, which only ever held
+    default gpt-4o-mini calls."""
+    return request_key("gpt-4o-mini", get_messages(prompt), None)
+
+
+def cached_response(content: str, model: str, messages: list[dict]):
+    ledger.record_cached(
+        model,
+        sum(estimate_tokens(message["content"], model) for message in messages),
+        estimate_tokens(content, model),
+    )
+    return GPTResponse(
+        content,
+        model,
+        CompletionUsage(completion_tokens=0, prompt_tokens=0, total_tokens=0),
+    )
+
+
 class GPTCache:
-    def __init__(self):
-        try:
-            self.cache = read_json("temp/gpt-cache.json")
-        except:
-            self.cache = {}
-            self.save()
+    def __init__(self, max_memory_items=CACHE_MEMORY_SIZE, ttl=CACHE_TTL):
+        self.cache = DiskCache(
+            "temp/gpt-cache.db", "completions", max_memory_items, ttl
+        )
+        # Older caches were keyed by the prompt alone, so their entries are
+        # re-keyed as the default call that produced them
+        migrate_json("temp/gpt-cache.json", self.cache, legacy_key)
+        migrate_table("responses", self.cache, legacy_key)
+
+    def add(self, key: str, response: str):
+        self.cache.add(key, response)
 
-    def add(self, prompt: str, response: str):
-        self.cache[prompt] = response
+    def get(self, key: str) -> str | None:
+        return self.cache.get(key)
 
-    def get(self, prompt: str) -> str | None:
-        return self.cache.get(prompt)
+    def stats(self):
+        return self.cache.stats()
 
-    def save(self):
-        save_json("temp/gpt-cache.json", self.cache)
+    def close(self):
+        self.cache.close()
 
     def clear(self):
-        self.cache = {}
+        self.cache.clear()
 
 
 cache = GPTCache()
 
 
+class EmbeddingCache:
+    def __init__(self, max_memory_items=EMBEDDING_CACHE_MEMORY_SIZE, ttl=CACHE_TTL):
+        self.cache = DiskCache(
+            "temp/embedding-cache.db", "embeddings", max_memory_items, ttl
+        )
+
+    def key(self, text: str, model: str):
+        return model + ":" + sha256(text.encode()).hexdigest()
+
+    def add(self, text: str, model: str, vector: list[float]):
+        self.cache.add(
+            self.key(text, model), np.asarray(vector, dtype=np.float32).tobytes()
+        )
+
+    def add_many(self, items: list[tuple[str, list[float]]], model: str):
+        self.cache.add_many(
+            [
+                (self.key(text, model), np.asarray(vector, dtype=np.float32).tobytes())
+                for text, vector in items
+            ]
+        )
+
+    def get(self, text: str, model: str) -> list[float] | None:
+        value = self.cache.get(self.key(text, model))
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
+
+    def clear(self):
+        self.cache.clear()
+
+
+embedding_cache = EmbeddingCache()
+
+
 class EmbeddingResponse:
     def __init__(self, vector: list[float], model: str, usage: Usage):
         self.vector = vector
@@ -102,7 +247,7 @@ class EmbeddingResponse:
         self.usage = usage
 
     def get_cost(self):
-        return self.usage.total_tokens * prices[self.model]
+        return get_cost(self.model, self.usage.total_tokens)
 
 
 def call_gpt(
@@ -111,11 +256,15 @@ def call_gpt(
     system=DEFAULT_SYSTEM,
     max_tokens: int | None = None,
 ):
-    messages = []
-    if system:
-        messages.append({"role": "system", "content": system})
+    messages = get_messages(prompt, system)
 
-    messages.append({"role": "user", "content": prompt})
+    key = request_key(model, messages, max_tokens)
+    cached = cache.get(key)
+
+    if cached:
+        return cached_response(cached, model, messages)
+
+    start = time.monotonic()
 
     result = client.chat.completions.create(
         model=model,
@@ -126,14 +275,33 @@ def call_gpt(
     if not result.choices[0].message.content or not result.usage:
         raise Exception("Error calling GPT")
 
-    return GPTResponse(
+    ledger.record(
+        result.model,
+        result.usage.prompt_tokens,
+        result.usage.completion_tokens,
+        time.monotonic() - start,
+    )
+
+    response = GPTResponse(
         result.choices[0].message.content,
         result.model,
         result.usage,
     )
 
+    cache.add(key, str(response))
+
+    return response
+
 
 async def get_embedding(text: str, model="text-embedding-3-large"):
+    cached = embedding_cache.get(text, model)
+
+    if cached is not None:
+        ledger.record_cached(model, estimate_tokens(text, model))
+        return EmbeddingResponse(cached, model, Usage(prompt_tokens=0, total_tokens=0))
+
+    start = time.monotonic()
+
     result = await asyncClient.embeddings.create(
         input=text,
         model=model,
@@ -142,6 +310,10 @@ async def get_embedding(text: str, model="text-embedding-3-large"):
     if not result.usage:
         raise Exception("Error getting embeddings")
 
+    ledger.record(model, result.usage.total_tokens, latency=time.monotonic() - start)
+
+    embedding_cache.add(text, model, result.data[0].embedding)
+
     return EmbeddingResponse(
         result.data[0].embedding,
         result.model,
@@ -150,12 +322,35 @@ async def get_embedding(text: str, model="text-embedding-3-large"):
 
 
 async def get_embeddings(
-    texts: list[str], model="text-embedding-3-large", progress_bar=False
+    texts: list[str], model="text-embedding-3-large", progress_bar=False, batch=False
 ):
-    p = Progress(ceil(len(texts) / 2048)) if progress_bar else None
+    if batch:
+        from helpers.batch import batch_embeddings
+
+        return await batch_embeddings(texts, model)
+
+    cached: dict[str, EmbeddingResponse] = {}
+    misses: list[str] = []
+
+    for text in dict.fromkeys(texts):
+        vector = embedding_cache.get(text, model)
+        if vector is None:
+            misses.append(text)
+        else:
+            ledger.record_cached(model, estimate_tokens(text, model))
+            cached[text] = EmbeddingResponse(
+                vector, model, Usage(prompt_tokens=0, total_tokens=0)
+            )
+
+    p = Progress(ceil(len(misses) / 2048)) if progress_bar else None
 
     async def embed(input: list[str], model: str, progress: Progress | None = None):
+        start = time.monotonic()
         result = await asyncClient.embeddings.create(input=input, model=model)
+        if result.usage:
+            ledger.record(
+                model, result.usage.total_tokens, latency=time.monotonic() - start
+            )
         if progress:
             progress.increment()
         return result
@@ -163,43 +358,134 @@ async def get_embeddings(
     responses = await queue(
         [
             partial(embed, input=textBatch, model=model, progress=p)
-            for textBatch in chunk_list(texts, 2048)
+            for textBatch in chunk_list(misses, 2048)
         ],
-        10,
+        limiter=get_limiter(model),
+        weights=[
+            sum(estimate_tokens(text, model) for text in textBatch)
+            for textBatch in chunk_list(misses, 2048)
+        ],
+        retries=2,
+        breaker=get_breaker(model),
     )
 
-    result: list[EmbeddingResponse] = []
-
-    for response in responses:
+    for textBatch, response in zip(chunk_list(misses, 2048), responses):
+        if isinstance(response, TaskFailure):
+            raise Exception(f"Error getting embeddings: {response.error}") from (
+                response.error
+            )
         if not response or not response.usage:
             raise Exception("Error getting embeddings")
-        result += [
-            EmbeddingResponse(embedding.embedding, model, response.usage)
-            for embedding in response.data
-        ]
+        embedding_cache.add_many(
+            [
+                (text, embedding.embedding)
+                for text, embedding in zip(textBatch, response.data)
+            ],
+            model,
+        )
+        for text, embedding in zip(textBatch, response.data):
+            tokens = estimate_tokens(text, model)
+            cached[text] = EmbeddingResponse(
+                embedding.embedding,
+                model,
+                Usage(prompt_tokens=tokens, total_tokens=tokens),
+            )
 
     p.finish() if p else None
 
-    return result
+    return [cached[text] for text in texts]
+
+
+class EmbeddingBatcher:
+    """Groups texts from many concurrent callers into embedding requests.
+
+    A request is sent as soon as `size` texts are waiting, or `timeout`
+    seconds after the oldest waiting text arrived.
+    """
+
+    def __init__(self, model="text-embedding-3-large", size=2048, timeout=0.5):
+        self.model = model
+        self.size = size
+        self.timeout = timeout
+        self.waiting: list[tuple[str, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        for text in texts:
+            future = loop.create_future()
+            self.waiting.append((text, future))
+            futures.append(future)
+            if len(self.waiting) >= self.size:
+                self.flush()
+
+        if self.waiting and self.timer is None:
+            self.timer = loop.call_later(self.timeout, self.flush)
+
+        return list(await asyncio.gather(*futures))
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
 
+        batch, self.waiting = self.waiting[: self.size], self.waiting[self.size :]
 
-def batch_call(body: list):
-    file = ""
-    for i, item in enumerate(body):
-        item["custom_id"] = str(i)
-        file += stringify(item) + "\n"
+        if batch:
+            task = asyncio.ensure_future(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
 
-    file_name = SRC_DIR + "temp/" + uuid4().hex + ".jsonl"
-    save_file(file_name, file)
-    batch_input_file = client.files.create(file=open(file_name, "rb"), purpose="batch")
-    delete_file(file_name)
+        if self.waiting:
+            self.timer = asyncio.get_running_loop().call_later(self.timeout, self.flush)
+
+    async def send(self, batch: list[tuple[str, asyncio.Future]]):
+        try:
+            embeddings = await get_embeddings([text for text, _ in batch], self.model)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding.vector)
+
+
+BATCH_DIR = "temp/batches/"
+
+
+# Per embeddings request: at most 2048 inputs and 300k tokens; the token
+# budget stays under that to absorb tokenizer drift
+EMBEDDING_BATCH_INPUTS = 2048
+EMBEDDING_BATCH_TOKENS = 250_000
+
+
+def batch_call(body: Iterable[dict], endpoint="/v1/chat/completions"):
+    os.makedirs(SRC_DIR + BATCH_DIR, exist_ok=True)
+
+    file_name = BATCH_DIR + uuid4().hex + ".jsonl"
+    with open(SRC_DIR + file_name, "w") as f:
+        for i, item in enumerate(body):
+            item["custom_id"] = str(i)
+            f.write(stringify(item) + "\n")
+
+    with open(SRC_DIR + file_name, "rb") as f:
+        batch_input_file = client.files.create(file=f, purpose="batch")
 
     batch = client.batches.create(
         input_file_id=batch_input_file.id,
-        endpoint="/v1/chat/completions",
+        endpoint=endpoint,  # type: ignore
         completion_window="24h",
     )
 
+    # Kept so results can be mapped back to their requests by custom_id
+    os.replace(SRC_DIR + file_name, SRC_DIR + BATCH_DIR + batch.id + ".input.jsonl")
+
     return batch.id
 
 
@@ -210,57 +496,80 @@ def batch_gpt_call(
     system=DEFAULT_SYSTEM,
     max_tokens: int | None = None,
 ):
-    calls = []
-    for prompt in prompts:
-        messages = []
-        if system:
-            messages.append({"role": "system", "content": system})
-
-        messages.append({"role": "user", "content": prompt})
-        body = {
-            "model": model,
-            "messages": messages,
-        }
-        if max_tokens:
-            body["max_tokens"] = max_tokens
-
-        calls.append(
-            {
+    def calls():
+        for prompt in prompts:
+            messages = get_messages(prompt, system)
+            body = {
+                "model": model,
+                "messages": messages,
+            }
+            if max_tokens:
+                body["max_tokens"] = max_tokens
+
+            yield {
                 "method": "POST",
                 "url": "/v1/chat/completions",
                 "body": body,
             }
-        )
 
-    batch_id = batch_call(calls)
+    batch_id = batch_call(calls())
+
+    from helpers.batch import batches
 
-    add_to_file(SRC_DIR + "../running-batches.txt", f"{batch_name}: {batch_id}\n")
+    batches.track(batch_id, batch_name, "chat")
+
+    add_to_file("../running-batches.txt", f"{batch_name}: {batch_id}\n")
 
     print(f"GPT batch ({batch_name}) created with ID ({batch_id})")
 
     return batch_id
 
 
+def embedding_inputs(texts: list[str], model: str):
+    """Packs texts into request-sized lists of inputs."""
+    inputs: list[str] = []
+    tokens = 0
+    for text in texts:
+        text_tokens = estimate_tokens(text, model)
+        if inputs and (
+            len(inputs) >= EMBEDDING_BATCH_INPUTS
+            or tokens + text_tokens > EMBEDDING_BATCH_TOKENS
+        ):
+            yield inputs
+            inputs = []
+            tokens = 0
+        inputs.append(text)
+        tokens += text_tokens
+    if inputs:
+        yield inputs
+
+
 def batch_embedding_call(
     batch_name: str,
     texts: list[str],
-    model="text-embedding-3-small",
+    model="text-embedding-3-large",
 ):
     batch_id = batch_call(
-        [
+        (
             {
                 "method": "POST",
-                "url": "/v1/engines/text-embedding-3-small/completions",
+                "url": "/v1/embeddings",
                 "body": {
-                    "input": text,
+                    "input": inputs,
                     "model": model,
+                    "encoding_format": "float",
                 },
             }
-            for text in texts
-        ]
+            for inputs in embedding_inputs(texts, model)
+        ),
+        "/v1/embeddings",
     )
 
-    add_to_file(SRC_DIR + "../running-batches.txt", f"{batch_name}: {batch_id}\n")
+    from helpers.batch import batches
+
+    batches.track(batch_id, batch_name, "embedding")
+
+    add_to_file("../running-batches.txt", f"{batch_name}: {batch_id}\n")
 
     print(f"Embedding batch ({batch_name}) created with ID ({batch_id})")
 
@@ -283,58 +592,46 @@ async def async_call_gpt(
     max_tokens: int | None = None,
     progress: Progress | None = None,
 ) -> GPTResponse:
-    messages = []
-    if system:
-        messages.append({"role": "system", "content": system})
+    messages = get_messages(prompt, system)
 
-    messages.append({"role": "user", "content": prompt})
+    key = request_key(model, messages, max_tokens)
+    cached = cache.get(key)
 
-    if cache.get(prompt):
+    if cached:
         if progress:
             progress.increment()
-        return GPTResponse(
-            cache.get(prompt) or "",
-            model,
-            CompletionUsage(completion_tokens=0, prompt_tokens=0, total_tokens=0),
-        )
+        return cached_response(cached, model, messages)
+
+    start = time.monotonic()
 
     try:
-        result = await asyncio.wait_for(
-            asyncClient.chat.completions.create(
+        result = await hedged(
+            partial(
+                asyncClient.chat.completions.create,
                 model=model,
                 messages=messages,
                 max_tokens=max_tokens,
             ),
-            timeout=10,
+            get_latency(model),
+            get_hedge_budget(model),
+            HEDGE_PERCENTILE,
+            REQUEST_TIMEOUT,
         )
-    except asyncio.TimeoutError:
-        try:
-            result = await asyncio.wait_for(
-                asyncClient.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                ),
-                timeout=20,
-            )
-        except asyncio.TimeoutError:
-            try:
-                result = await asyncio.wait_for(
-                    asyncClient.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        max_tokens=max_tokens,
-                    ),
-                    timeout=30,
-                )
-            except:
-                if progress:
-                    progress.increment()
-                raise Exception("Error calling GPT")
+    except Exception as e:
+        if progress:
+            progress.increment()
+        raise Exception("Error calling GPT") from e
 
     if not result.choices[0].message.content or not result.usage:
         raise Exception("Error calling GPT")
 
+    ledger.record(
+        result.model,
+        result.usage.prompt_tokens,
+        result.usage.completion_tokens,
+        time.monotonic() - start,
+    )
+
     if progress:
         progress.increment()
 
@@ -344,38 +641,214 @@ async def async_call_gpt(
         result.usage,
     )
 
-    cache.add(prompt, str(response))
+    cache.add(key, str(response))
 
     return response
 
 
+def estimate_gpt_calls(
+    prompts: list[str],
+    model="gpt-4o-mini",
+    system=DEFAULT_SYSTEM,
+    max_tokens: int | None = None,
+    completion_tokens=300,
+):
+    """Pre-flight token, cost and duration estimate for a set of prompts."""
+    prompt_tokens = sum(estimate_tokens(system + prompt, model) for prompt in prompts)
+    completion_tokens = len(prompts) * (max_tokens or completion_tokens)
+    limits = rate_limits.get(model, {})
+
+    return {
+        "requests": len(prompts),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost": get_cost(model, prompt_tokens, completion_tokens),
+        "minutes": max(
+            len(prompts) / limits.get("requests", float("inf")),
+            (prompt_tokens + completion_tokens) / limits.get("tokens", float("inf")),
+        ),
+    }
+
+
+def print_estimate(estimate: dict):
+    print(
+        f"Estimated: {estimate['requests']} requests, "
+        f"{estimate['prompt_tokens'] + estimate['completion_tokens']} tokens, "
+        f"${estimate['cost']:.2f}, {estimate['minutes']:.1f} min at rate limits"
+    )
+
+
+def realtime_capacity(
+    prompts: list[str],
+    seconds: float,
+    model="gpt-4o-mini",
+    system=DEFAULT_SYSTEM,
+    max_tokens: int | None = None,
+    completion_tokens=300,
+):
+    """How many of `prompts`, in order, the rate limits let finish within `seconds`."""
+    limits = rate_limits.get(model, {})
+    tokens = 0
+    for n, prompt in enumerate(prompts):
+        tokens += estimate_tokens(system + prompt, model) + (
+            max_tokens or completion_tokens
+        )
+        minutes = max(
+            (n + 1) / limits.get("requests", float("inf")),
+            tokens / limits.get("tokens", float("inf")),
+        )
+        if minutes * 60 > seconds:
+            return n
+    return len(prompts)
+
+
 async def async_gpt_calls(
     prompts: list[str],
     model="gpt-4o-mini",
     system=DEFAULT_SYSTEM,
     max_tokens: int | None = None,
     progress_bar: bool = False,
-) -> list[GPTResponse]:
+    mode: Literal["realtime", "batch", "auto"] = "realtime",
+    latency_budget: float | None = None,
+) -> list[GPTResponse | TaskFailure]:
+    """Calls GPT for every prompt, returning responses in prompt order.
+
+    In "batch" mode uncached prompts go through the Batch API. In "auto" mode,
+    workloads of at least `BATCH_THRESHOLD` uncached prompts send as many as the
+    rate limits can finish within `latency_budget` seconds in realtime and batch
+    the rest (all of them when there is no budget, or it covers `BATCH_WINDOW`).
+    Anything the batch fails on is retried in realtime.
+    """
     p = Progress(len(prompts)) if progress_bar else None
 
-    results = await queue(
+    results: list = [
+        cache.get(request_key(model, get_messages(prompt, system), max_tokens))
+        for prompt in prompts
+    ]
+    misses = [i for i, result in enumerate(results) if not result]
+
+    for i, result in enumerate(results):
+        if result:
+            results[i] = cached_response(result, model, get_messages(prompts[i], system))
+            if p:
+                p.increment()
+
+    batched: list[int] = []
+    if mode == "batch":
+        batched = misses
+    elif mode == "auto" and len(misses) >= BATCH_THRESHOLD:
+        if latency_budget is None or latency_budget >= BATCH_WINDOW:
+            batched = misses
+        else:
+            batched = misses[
+                realtime_capacity(
+                    [prompts[i] for i in misses],
+                    latency_budget,
+                    model,
+                    system,
+                    max_tokens,
+                ) :
+            ]
+    realtime = misses[: len(misses) - len(batched)]
+
+    async def run_realtime(indices: list[int]):
+        if progress_bar and indices:
+            print_estimate(
+                estimate_gpt_calls(
+                    [prompts[i] for i in indices], model, system, max_tokens
+                )
+            )
+
+        # Progress moves once per prompt as it settles, not once per attempt
+        async for j, response in stream_queue(
+            [
+                partial(
+                    async_call_gpt,
+                    prompts[i],
+                    model=model,
+                    system=system,
+                    max_tokens=max_tokens,
+                )
+                for i in indices
+            ],
+            limiter=get_limiter(model),
+            weights=[
+                estimate_tokens(system + prompts[i], model) + (max_tokens or 0)
+                for i in indices
+            ],
+            retries=2,
+            breaker=get_breaker(model),
+        ):
+            results[indices[j]] = response
+            p.increment() if p else None
+
+    async def run_batch(indices: list[int]):
+        if not indices:
+            return
+
+        from helpers.batch import batch_gpt_calls
+
+        batch_results = await batch_gpt_calls(
+            [prompts[i] for i in indices], model, system, max_tokens
+        )
+
+        for i, result in zip(indices, batch_results):
+            results[i] = result
+            if result and p:
+                p.increment()
+
+        await run_realtime([i for i in indices if not results[i]])
+
+    await asyncio.gather(run_realtime(realtime), run_batch(batched))
+
+    p.finish() if p else None
+
+    return results
+
+
+async def stream_gpt_calls(
+    prompts: list[str],
+    model="gpt-4o-mini",
+    system=DEFAULT_SYSTEM,
+    max_tokens: int | None = None,
+    progress_bar: bool = False,
+):
+    """Like async_gpt_calls in realtime mode, but yields (index, response) as each call finishes."""
+    p = Progress(len(prompts)) if progress_bar else None
+    misses: list[int] = []
+
+    for i, prompt in enumerate(prompts):
+        cached = cache.get(request_key(model, get_messages(prompt, system), max_tokens))
+        if cached:
+            p.increment() if p else None
+            yield i, cached_response(cached, model, get_messages(prompt, system))
+        else:
+            misses.append(i)
+
+    async for j, response in stream_queue(
         [
             partial(
                 async_call_gpt,
-                prompt,
+                prompts[i],
                 model=model,
                 system=system,
                 max_tokens=max_tokens,
-                progress=p,
             )
-            for prompt in prompts
+            for i in misses
         ],
-        100 if model == "gpt-4o-mini" else 20,
-    )
+        limiter=get_limiter(model),
+        weights=[
+            estimate_tokens(system + prompts[i], model) + (max_tokens or 0)
+            for i in misses
+        ],
+        retries=2,
+        breaker=get_breaker(model),
+    ):
+        p.increment() if p else None
+        yield misses[j], response
 
     p.finish() if p else None
 
-    return results
-
 
-atexit.register(cache.save)
+atexit.register(cache.close)
+atexit.register(embedding_cache.close)
@@ -1,48 +1,385 @@
 import asyncio
+import atexit
+import heapq
 import os
-from dotenv import load_dotenv
-from pinecone import Pinecone
+import shutil
+import time
+from collections.abc import AsyncIterable, Iterable, Sized
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from hashlib import sha256
 from typing import Literal, Any
 
-from helpers.data import chunk_list
-from helpers.oai import get_embedding, get_embeddings
+import numpy as np
+
+from helpers.cache import DiskCache
+from helpers.data import (
+    TaskFailure,
+    chunk_list,
+    iterate,
+    parse,
+    read_json,
+    save_json,
+    stream_queue,
+    stringify,
+)
+from helpers.docstore import get_docstore, remove_docstore
+from helpers.latency import get_latency, latencies, timed
+from helpers.oai import embedding_cache, get_embedding, get_embeddings
 from helpers.progress import Progress
+from helpers.variables import SRC_DIR
+from helpers.vector_store import INDEX_POOL_SIZE, SNAPSHOT_DIR, Match, store
 
-load_dotenv()
+QUERY_BATCH_SIZE = 256
+QUERY_RETRIES = 3
 
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-PINECONE_HOST = os.getenv("PINECONE_HOST")
+QUERY_CACHE_MEMORY_SIZE = 10_000
+# Matches are refetched after this long, in case the index was written to
+# without going through upsert_index (another machine, the Pinecone console)
+QUERY_CACHE_TTL = 24 * 60 * 60
 
-if not PINECONE_API_KEY:
-    raise Exception("Pinecone API Key not found")
+UPSERT_CHUNK_SIZE = 100
+UPSERT_WINDOW = 30
+UPSERT_RETRIES = 3
+# Acknowledged chunks between checkpoint writes
+CHECKPOINT_INTERVAL = 20
+CHECKPOINT_DIR = "temp/upserts/"
 
-if not PINECONE_HOST:
-    raise Exception("Pinecone Host not found")
+SCAN_PAGE_SIZE = 100
+EXPORT_DIR = "temp/exports/"
+
+# Rank offset for reciprocal-rank fusion
+RRF_K = 60
+
+# Every store call runs here so the blocking client never holds the event loop
+executor = ThreadPoolExecutor(INDEX_POOL_SIZE)
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(host=PINECONE_HOST)
 
 class QueryResponse:
     def __init__(self, matches):
         self.matches = matches
 
 
-def upsert_index(namespace: str, vectors: list[dict]):
-    result = []
+async def run_index(operation: str, func, *args, **kwargs):
+    """Runs a blocking store call in the executor, timing it under index.<operation>."""
+    loop = asyncio.get_running_loop()
+    return await timed(
+        lambda: loop.run_in_executor(executor, partial(func, *args, **kwargs)),
+        get_latency("index." + operation),
+    )
+
 
-    chunks = chunk_list(vectors, 100)
+def index_stats():
+    return {
+        name.removeprefix("index."): histogram.stats()
+        for name, histogram in latencies.items()
+        if name.startswith("index.")
+    }
 
-    batches = chunk_list(chunks, 30)
 
-    for batch in batches:
-        requests = [
-            index.upsert(namespace=namespace, vectors=chunk, async_req=True)
-            for chunk in batch
-        ]
+class QueryCache:
+    """Index matches keyed by query vector, top_k and filter.
 
-        result += [request.result() for request in requests]  # type: ignore
+    Keys include a per-namespace version that upsert_index bumps, so writes
+    invalidate every cached result for that namespace. The version is read
+    from sqlite on every lookup so bumps from other processes are seen.
+    """
 
-    return result
+    def __init__(self, max_memory_items=QUERY_CACHE_MEMORY_SIZE, ttl=QUERY_CACHE_TTL):
+        self.cache = DiskCache(
+            "temp/query-cache.db", "matches", max_memory_items, ttl
+        )
+        self.versions = DiskCache("temp/query-cache.db", "versions")
+
+    def version(self, namespace: str) -> int:
+        row = self.versions.connection.execute(
+            "SELECT value FROM versions WHERE key = ?", (namespace,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, namespace: str):
+        self.versions.connection.execute(
+            "INSERT INTO versions (key, value, created) VALUES (?, 1, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1, created = ?",
+            (namespace, time.time(), time.time()),
+        )
+
+    def key(
+        self,
+        namespace: str,
+        vector: list[float],
+        top_k: int,
+        include_metadata: bool,
+        include_vector: bool,
+        filter: dict | None,
+    ):
+        return sha256(
+            stringify(
+                [
+                    store.name,
+                    namespace,
+                    self.version(namespace),
+                    sha256(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest(),
+                    top_k,
+                    include_metadata,
+                    include_vector,
+                    filter or {},
+                ]
+            ).encode()
+        ).hexdigest()
+
+    def add(self, key: str, matches: list):
+        self.cache.add(
+            key,
+            stringify(
+                [
+                    {
+                        "id": match.id,
+                        "score": match.score,
+                        "metadata": match.metadata,
+                        "values": list(match.values or []),
+                    }
+                    for match in matches
+                ]
+            ),
+        )
+
+    def get(self, key: str) -> list[Match] | None:
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        return [Match(**match) for match in parse(value)]
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
+        self.versions.close()
+
+    def clear(self):
+        self.cache.clear()
+
+
+query_cache = QueryCache()
+
+atexit.register(query_cache.close)
+
+
+def retrieval_stats():
+    """Hit rates for both cache levels: query text to vector, and vector to matches."""
+    stats = {}
+    for name, level in [("embeddings", embedding_cache), ("matches", query_cache)]:
+        level_stats = level.stats()
+        lookups = level_stats["hits"] + level_stats["misses"]
+        stats[name] = {
+            **level_stats,
+            "hit_rate": level_stats["hits"] / lookups if lookups else None,
+        }
+    return stats
+
+
+def store_chunk(namespace: str, chunk: list[dict]):
+    """Moves passage text into the namespace's docstore and upserts the rest."""
+    docs = [
+        (
+            vector["id"],
+            {
+                "content": vector["metadata"]["content"],
+                "ids": vector["metadata"].get("ids", []),
+            },
+        )
+        for vector in chunk
+        if "content" in (vector.get("metadata") or {})
+    ]
+
+    if docs:
+        get_docstore(namespace).add_many(docs)
+
+    return store.upsert(
+        namespace,
+        [
+            {
+                **vector,
+                "metadata": {
+                    key: value
+                    for key, value in (vector.get("metadata") or {}).items()
+                    if key != "content"
+                },
+            }
+            for vector in chunk
+        ],
+    )
+
+
+def hydrate(namespace: str, matches: list):
+    """Fills metadata["content"] from the docstore for matches that carry metadata."""
+    docs = get_docstore(namespace, create=False)
+    if docs is None:
+        return matches
+    for match in matches:
+        if match.metadata is not None and "content" not in match.metadata:
+            doc = docs.get(match.id)
+            if doc is not None:
+                # A new dict, since the store may hand out its own metadata
+                match.metadata = {**match.metadata, "content": doc["content"]}
+    return matches
+
+
+async def upsert_index(
+    namespace: str,
+    vectors: Iterable[dict] | AsyncIterable[dict],
+    total: int | None = None,
+    progress=False,
+    resume=True,
+):
+    """Streams `vectors` into the index in chunks, with at most UPSERT_WINDOW in flight.
+
+    Passage text in metadata["content"] goes to the namespace's docstore, so
+    the index only keeps IDs and small filter fields. Acknowledged chunks are
+    recorded in a checkpoint file with a hash of their IDs, so rerunning an
+    interrupted build skips a chunk only if it holds the same vectors as
+    before. Pass resume=False to ignore the checkpoint.
+    """
+    checkpoint = CHECKPOINT_DIR + namespace + ".json"
+    # Chunk number -> hash of the chunk's IDs
+    done: dict[str, str] = {}
+
+    if resume:
+        try:
+            done = read_json(checkpoint)["chunks"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        # Checkpoints from before chunks were hashed can't be matched to input
+        if not isinstance(done, dict):
+            done = {}
+
+    if total is None and isinstance(vectors, Sized):
+        total = len(vectors)
+
+    p = Progress(total, "Upserting") if progress and total else None
+
+    # Chunk number, ID hash and size of each job, in the order stream_queue
+    # indexes them
+    jobs_chunks: list[tuple[str, str, int]] = []
+    upserted = 0
+
+    def job(number: int, chunk: list[dict]):
+        nonlocal upserted
+        fingerprint = sha256(stringify([v["id"] for v in chunk]).encode()).hexdigest()
+        if done.get(str(number)) == fingerprint:
+            upserted += len(chunk)
+            p.update(upserted) if p else None
+            return None
+        jobs_chunks.append((str(number), fingerprint, len(chunk)))
+        return partial(run_index, "upsert", store_chunk, namespace, chunk)
+
+    async def jobs():
+        chunk: list[dict] = []
+        number = 0
+        async for vector in iterate(vectors):
+            chunk.append(vector)
+            if len(chunk) < UPSERT_CHUNK_SIZE:
+                continue
+            if pending := job(number, chunk):
+                yield pending
+            chunk = []
+            number += 1
+        if chunk and (pending := job(number, chunk)):
+            yield pending
+
+    failures = 0
+    unsaved = 0
+
+    def save_checkpoint():
+        # Written aside and swapped in, so an interrupted write can't corrupt it
+        save_json(checkpoint + ".part", {"chunks": done})
+        os.replace(SRC_DIR + checkpoint + ".part", SRC_DIR + checkpoint)
+
+    try:
+        async for i, result in stream_queue(
+            jobs(), UPSERT_WINDOW, retries=UPSERT_RETRIES
+        ):
+            number, fingerprint, size = jobs_chunks[i]
+            if isinstance(result, TaskFailure):
+                print(f"Error upserting chunk {number}:", result.error)
+                failures += 1
+                continue
+            done[number] = fingerprint
+            unsaved += 1
+            if unsaved >= CHECKPOINT_INTERVAL:
+                save_checkpoint()
+                unsaved = 0
+            upserted += size
+            p.update(upserted) if p else None
+    finally:
+        if unsaved:
+            save_checkpoint()
+        query_cache.bump(namespace)
+        p.finish() if p else None
+
+    if failures:
+        raise Exception(
+            f"{failures} chunks failed to upsert into {namespace}, rerun to resume"
+        )
+
+    if os.path.exists(SRC_DIR + checkpoint):
+        os.remove(SRC_DIR + checkpoint)
+
+    return upserted
+
+
+async def delete_from_index(namespace: str, ids: list[str]):
+    if not ids:
+        return
+    try:
+        await run_index("delete", store.delete, namespace, ids)
+    finally:
+        query_cache.bump(namespace)
+
+
+async def clear_index(namespace: str):
+    """Deletes every vector in a namespace, along with its docstore and upsert
+    checkpoint."""
+    try:
+        await run_index("clear", store.clear, namespace)
+    finally:
+        query_cache.bump(namespace)
+
+    remove_docstore(namespace)
+
+    checkpoint = SRC_DIR + CHECKPOINT_DIR + namespace + ".json"
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+async def search(
+    namespace: str,
+    vector: list[float],
+    top_k: int,
+    include_metadata: bool,
+    include_vector: bool,
+    filter: dict | None,
+):
+    key = query_cache.key(
+        namespace, vector, top_k, include_metadata, include_vector, filter
+    )
+    matches = query_cache.get(key)
+
+    if matches is None:
+        matches = await run_index(
+            "query",
+            store.query,
+            namespace,
+            vector,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            include_values=include_vector,
+            filter=filter,
+        )
+        query_cache.add(key, matches)
+
+    return hydrate(namespace, matches)
 
 
 async def embed_small(
@@ -92,15 +429,11 @@ async def query_index(
     filter={},
 ):
     embedding = await get_embedding(query)
-    response = index.query(
-        namespace=namespace,
-        vector=embedding.vector,
-        top_k=top_k,
-        include_metadata=include_metadata,
-        include_values=include_vector,
-        filter=filter,
+    response_obj = QueryResponse(
+        await search(
+            namespace, embedding.vector, top_k, include_metadata, include_vector, filter
+        )
     )
-    response_obj = QueryResponse(response.matches)
     return [match for match in response_obj.matches if match.score >= min_score]
 
 
@@ -117,17 +450,12 @@ async def async_query_index(
     async def run(query, namespace, top_k, include_metadata, include_vector, filter):
         if isinstance(query, str):
             query = (await get_embedding(query)).vector
-        response = index.query(
-            namespace=namespace,
-            vector=query,
-            top_k=top_k,
-            include_metadata=include_metadata,
-            include_values=include_vector,
-            filter=filter,
+        matches = await search(
+            namespace, query, top_k, include_metadata, include_vector, filter
         )
         if progress:
             progress.increment()
-        return [match for match in response.matches if match.score >= min_score]
+        return [match for match in matches if match.score >= min_score]
 
     try:
         result = await asyncio.wait_for(
@@ -155,24 +483,51 @@ async def multiple_queries(
 
     p = Progress(len(embeddings)) if progress else None
 
-    responses = await asyncio.gather(
-        *[
-            async_query_index(
-                embedding.vector,
+    keys = [
+        query_cache.key(
+            namespace, embedding.vector, top_k, include_metadata, include_vector, None
+        )
+        for embedding in embeddings
+    ]
+    responses: list = [query_cache.get(key) for key in keys]
+    misses = [i for i, response in enumerate(responses) if response is None]
+    done = len(responses) - len(misses)
+
+    p.update(done) if p else None
+
+    # The local store scores a chunk in one matrix product; Pinecone takes one
+    # request per query, each a separate job on the shared index executor
+    chunks = chunk_list(misses, QUERY_BATCH_SIZE if store.batch_queries else 1)
+
+    async for j, results in stream_queue(
+        [
+            partial(
+                run_index,
+                "query_many" if store.batch_queries else "query",
+                store.query_many,
                 namespace,
-                top_k=top_k,
-                include_metadata=include_metadata,
-                include_vector=include_vector,
-                progress=p,
+                [embeddings[i].vector for i in chunk],
+                top_k,
+                include_metadata,
+                include_vector,
             )
-            for embedding in embeddings
-        ]
-    )
+            for chunk in chunks
+        ],
+        INDEX_POOL_SIZE,
+        retries=QUERY_RETRIES,
+    ):
+        if isinstance(results, TaskFailure):
+            raise Exception(f"Error querying index: {results.error}") from results.error
+        for i, matches in zip(chunks[j], results):
+            query_cache.add(keys[i], matches)
+            responses[i] = matches
+        done += len(chunks[j])
+        p.update(done) if p else None
 
     p.finish() if p else None
 
     return [
-        [match for match in response if match.score >= min_score]
+        [match for match in hydrate(namespace, response) if match.score >= min_score]
         for response in responses
     ]
 
@@ -185,7 +540,10 @@ async def query_batches(
     include_vector=False,
     min_score=0.0,
     progress: bool = False,
+    fusion: Literal["max", "sum", "rrf"] = "max",
+    batch_top_k: int | None = None,
 ):
+    """Runs every sub-query and fuses the matches of each batch into one list."""
     flattened_results = await multiple_queries(
         [query for batch in queries for query in batch],
         namespace,
@@ -200,31 +558,195 @@ async def query_batches(
     i = 0
 
     for batch in queries:
-        to_add = []
-        for _ in batch:
-            to_add += flattened_results[i]
-            i += 1
-        to_add.sort(key=lambda x: x.score, reverse=True)
-        duplicates_removed = []
-        for match in to_add:
-            if match.id not in [m.id for m in duplicates_removed]:
-                duplicates_removed.append(match)
-
-        unflattened_results.append(duplicates_removed)
+        unflattened_results.append(
+            fuse(flattened_results[i : i + len(batch)], fusion, batch_top_k)
+        )
+        i += len(batch)
 
     return unflattened_results
 
 
-def content_from_query_result(result: QueryResponse | list) -> list[str]:
-    matches = result.matches if isinstance(result, QueryResponse) else result
+def fuse(
+    results: list[list],
+    fusion: Literal["max", "sum", "rrf"] = "max",
+    top_k: int | None = None,
+):
+    """Merges several match lists into one, best first, with one entry per ID.
+
+    "max" keeps each ID's best match, "sum" adds its scores across lists and
+    "rrf" adds 1 / (RRF_K + rank).
+    """
+    best: dict[str, Any] = {}
+    scores: dict[str, float] = {}
+
+    for matches in results:
+        for rank, match in enumerate(matches):
+            if fusion == "max":
+                score = max(scores.get(match.id, match.score), match.score)
+            elif fusion == "sum":
+                score = scores.get(match.id, 0.0) + match.score
+            elif fusion == "rrf":
+                score = scores.get(match.id, 0.0) + 1 / (RRF_K + rank + 1)
+            else:
+                raise Exception(f"Unknown fusion mode: {fusion}")
+            scores[match.id] = score
+            if match.id not in best or match.score > best[match.id].score:
+                best[match.id] = match
+
+    if top_k is None:
+        ids = sorted(scores, key=scores.__getitem__, reverse=True)
+    else:
+        ids = heapq.nlargest(top_k, scores, key=scores.__getitem__)
+
+    if fusion == "max":
+        return [best[id] for id in ids]
+
     return [
-        match.metadata["content"] 
-        for match in matches if hasattr(match, 'metadata') and "content" in match.metadata
+        Match(id, scores[id], best[id].metadata, best[id].values) for id in ids
     ]
 
 
-def get_namespace_size(namespace: str):
-    stats = index.describe_index_stats()
-    if namespace in stats.namespaces:
-        return stats.namespaces[namespace].vector_count
-    return 0
+async def scan_namespace(namespace: str, page_size=SCAN_PAGE_SIZE):
+    """Yields every vector in a namespace, a page of {"id", "values", "metadata"} at a time.
+
+    Content kept in the docstore is filled back into the metadata.
+    """
+    docs = get_docstore(namespace, create=False)
+    token = None
+
+    while True:
+        ids, token = await run_index(
+            "list", store.list_page, namespace, page_size, token
+        )
+
+        if ids:
+            vectors = await run_index("fetch", store.fetch, namespace, ids)
+            if docs is not None:
+                for vector in vectors:
+                    doc = docs.get(vector["id"])
+                    if doc is not None and "content" not in vector["metadata"]:
+                        vector["metadata"]["content"] = doc["content"]
+            yield vectors
+
+        if not token:
+            return
+
+
+async def export_namespace(namespace: str, path: str | None = None, progress=False):
+    """Writes a namespace to <path>/vectors.npy (float32) and <path>/metadata.jsonl.
+
+    Rows of the array line up with the lines of the metadata file. Returns the
+    vector count, dimension and total content length.
+    """
+    path = SRC_DIR + (path or EXPORT_DIR + namespace + "/")
+    os.makedirs(path, exist_ok=True)
+
+    p = Progress(await get_namespace_size(namespace), "Exporting") if progress else None
+
+    stats = {"count": 0, "dimension": 0, "content_length": 0}
+
+    with open(path + "vectors.f32.part", "wb") as vectors_file, open(
+        path + "metadata.jsonl.part", "w"
+    ) as metadata_file:
+        async for page in scan_namespace(namespace):
+            # IDs deleted between listing and fetching leave a page empty
+            if not page:
+                continue
+            rows = np.asarray([vector["values"] for vector in page], dtype=np.float32)
+            rows.tofile(vectors_file)
+            for vector in page:
+                metadata_file.write(
+                    stringify({"id": vector["id"], "metadata": vector["metadata"]})
+                    + "\n"
+                )
+                stats["content_length"] += len(
+                    str(vector["metadata"].get("content", ""))
+                )
+            stats["count"] += len(page)
+            stats["dimension"] = rows.shape[1]
+            p.update(stats["count"]) if p else None
+
+    # The row count is only known at the end, so the .npy header is written last
+    with open(path + "vectors.npy.part", "wb") as f, open(
+        path + "vectors.f32.part", "rb"
+    ) as rows_file:
+        np.lib.format.write_array_header_1_0(
+            f,
+            {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                "fortran_order": False,
+                "shape": (stats["count"], stats["dimension"]),
+            },
+        )
+        shutil.copyfileobj(rows_file, f)
+
+    os.remove(path + "vectors.f32.part")
+    os.replace(path + "vectors.npy.part", path + "vectors.npy")
+    os.replace(path + "metadata.jsonl.part", path + "metadata.jsonl")
+
+    p.finish() if p else None
+
+    return stats
+
+
+async def snapshot_namespace(namespace: str, progress=False):
+    """Exports a namespace to SNAPSHOT_DIR, where VECTOR_STORE=snapshot serves it."""
+    return await export_namespace(namespace, SNAPSHOT_DIR + namespace + "/", progress)
+
+
+async def restore_namespace(namespace: str, path: str | None = None, progress=False):
+    """Upserts a snapshot (or any export_namespace output) into the current store."""
+    path = SRC_DIR + (path or SNAPSHOT_DIR + namespace + "/")
+    vectors = np.load(path + "vectors.npy", mmap_mode="r")
+
+    def items():
+        with open(path + "metadata.jsonl", "r") as f:
+            for row, line in zip(vectors, f):
+                item = parse(line)
+                yield {
+                    "id": item["id"],
+                    "values": row.tolist(),
+                    "metadata": item["metadata"],
+                }
+
+    return await upsert_index(
+        namespace, items(), total=len(vectors), progress=progress
+    )
+
+
+async def namespace_stats(namespace: str):
+    """Exact vector count and total content length, from a full scan."""
+    stats = {"count": 0, "content_length": 0}
+    async for page in scan_namespace(namespace):
+        stats["count"] += len(page)
+        stats["content_length"] += sum(
+            len(str(vector["metadata"].get("content", ""))) for vector in page
+        )
+    return stats
+
+
+# Stands in for retrieved passages when estimating a pipeline before any queries
+ESTIMATE_CONTEXTS = ["lorem ipsum " * 75] * 5
+
+
+def content_from_query_result(
+    result: QueryResponse | list, namespace: str | None = None
+) -> list[str]:
+    """Passage text of each match, looked up in `namespace`'s docstore when the
+    match metadata does not carry it."""
+    matches = result.matches if isinstance(result, QueryResponse) else result
+    docs = get_docstore(namespace, create=False) if namespace else None
+    contents = []
+    for match in matches:
+        metadata = getattr(match, "metadata", None) or {}
+        if "content" in metadata:
+            contents.append(metadata["content"])
+        elif docs is not None:
+            doc = docs.get(match.id)
+            if doc is not None:
+                contents.append(doc["content"])
+    return contents
+
+
+async def get_namespace_size(namespace: str):
+    return await run_index("describe", store.namespace_size, namespace)
@@ -0,0 +1,538 @@
+import asyncio
+import os
+import shutil
+from collections.abc import Callable
+from hashlib import sha256
+
+import numpy as np
+
+from helpers.data import TaskFailure, read_json, save_json
+from helpers.dbscan import COSINE_THRESHOLD, cluster
+from helpers.oai import (
+    EmbeddingBatcher,
+    async_gpt_calls,
+    get_embeddings,
+    stream_gpt_calls,
+)
+from helpers.pc import clear_index, delete_from_index, multiple_queries, upsert_index
+from helpers.variables import SRC_DIR
+
+SUMMARY_DIR = "temp/summaries/"
+RUN_DIR = "temp/runs/"
+
+
+def content_hash(text: str):
+    return sha256(text.encode()).hexdigest()[:32]
+
+
+def cluster_id(statement_ids: list[str]):
+    """Vector ID of a cluster: the statement's own ID, or a hash of its members."""
+    if len(statement_ids) == 1:
+        return statement_ids[0]
+    return "c" + content_hash("\n".join(sorted(statement_ids)))
+
+
+def read_state(namespace: str):
+    try:
+        return read_json(SUMMARY_DIR + namespace + ".json")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def parse_statements(response) -> list[str]:
+    text = str(response).replace("\n- ", "\n").strip().removeprefix("- ")
+    return [statement.strip() for statement in text.split("\n") if statement.strip()]
+
+
+class Adapter:
+    """Everything the summarizer needs to know about a dataset.
+
+    `load` returns the passages to summarize, mapped to the question IDs they
+    answer. Without a `namespace` nothing is upserted and summarize() just
+    returns the final statements.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        load: Callable[[], dict[str, list[str]]],
+        get_statement_prompt: Callable[[str], str],
+        get_compress_prompt: Callable[[list[str]], str],
+        namespace: str | None = None,
+    ):
+        self.name = name
+        self.load = load
+        self.get_statement_prompt = get_statement_prompt
+        self.get_compress_prompt = get_compress_prompt
+        self.namespace = namespace
+
+
+class Run:
+    """Stage outputs of one summarization, kept under RUN_DIR until it finishes.
+
+    A finished stage is loaded instead of run again, so a crashed run picks
+    up at the stage it was in. Runs over different input start over.
+    """
+
+    def __init__(self, name: str, fingerprint: str):
+        self.path = RUN_DIR + name + "/"
+
+        try:
+            manifest = read_json(self.path + "run.json")
+        except (FileNotFoundError, ValueError):
+            manifest = None
+
+        if manifest is not None and manifest["fingerprint"] != fingerprint:
+            self.finish()
+        if manifest is None or manifest["fingerprint"] != fingerprint:
+            save_json(self.path + "run.json", {"fingerprint": fingerprint})
+
+    def file(self, stage: str, array: bool):
+        return SRC_DIR + self.path + stage + (".npy" if array else ".json")
+
+    async def stage(self, name: str, func: Callable, array=False):
+        """Returns the saved output of stage `name`, or runs `func` and saves it."""
+        path = self.file(name, array)
+        if os.path.exists(path):
+            print(f"Loaded {name} from the last run")
+            if array:
+                return np.load(path)
+            return read_json(self.path + name + ".json")
+
+        result = await func()
+
+        if array:
+            with open(path + ".part", "wb") as f:
+                np.save(f, np.asarray(result, dtype=np.float32))
+            os.replace(path + ".part", path)
+            return np.load(path)
+
+        save_json(self.path + name + ".json.part", result)
+        os.replace(path + ".part", path)
+        return result
+
+    def finish(self):
+        shutil.rmtree(SRC_DIR + self.path, ignore_errors=True)
+
+
+def check_failures(results: list, name: str):
+    failures = sum(isinstance(result, TaskFailure) for result in results)
+    if failures:
+        raise Exception(f"{failures} {name} failed, rerun to resume")
+
+
+async def summarize(
+    adapter: Adapter, incremental=False, threshold=COSINE_THRESHOLD, stream=False
+) -> list[dict]:
+    """Splits the adapter's passages into statements, clusters and compresses them.
+
+    Stages (statements, embeddings, clusters, compressions and the upserts)
+    save their output to the run directory, and independent stages overlap:
+    nearest-neighbour matching runs alongside clustering, and single
+    statements are upserted while the clusters are being compressed.
+
+    Vector IDs are derived from content (a statement's ID is the hash of its
+    text, a cluster's the hash of its members), and what was upserted is
+    recorded in SUMMARY_DIR, so a full rebuild deletes vectors that no longer
+    exist instead of leaving them behind. Statements are clustered by cosine
+    similarity of at least `threshold` in every kind of build.
+
+    With `incremental`, only passages not seen before are processed. Their
+    statements are clustered together by cosine similarity, then each group
+    joins the nearest existing vector in the namespace if it is at least
+    `threshold` similar. Only the clusters that changed are recompressed,
+    upserted, and have their old vectors deleted.
+
+    With `stream`, GPT calls go out in realtime and their results move on
+    without waiting for the rest: each passage's statements are queued for
+    embedding as soon as they are extracted, and each compression is
+    embedded and upserted as soon as it is written.
+    """
+    namespace = adapter.namespace
+    contexts = adapter.load()
+
+    previous = read_state(namespace) if namespace else None
+    if incremental and namespace is None:
+        raise Exception("Incremental summaries need a namespace")
+    if incremental and previous is None:
+        print("No previous summary of " + str(namespace) + ", running a full build")
+        incremental = False
+    state = previous if incremental else None
+    if state is None:
+        state = {"contexts": [], "statements": {}, "clusters": {}}
+    assert state is not None
+
+    seen = set(state["contexts"])
+    raw_contexts = [
+        context for context in contexts if content_hash(context) not in seen
+    ]
+
+    if not raw_contexts:
+        print("Nothing new to summarize")
+        return []
+
+    run = Run(
+        adapter.name,
+        content_hash(
+            str(incremental)
+            + str(stream)
+            + "".join(content_hash(context) for context in raw_contexts)
+            + "".join(state["contexts"])
+        ),
+    )
+
+    batcher = EmbeddingBatcher()
+    # Statement text -> vector, for statements embedded while extraction ran
+    streamed: dict[str, list[float]] = {}
+
+    async def stream_extract():
+        responses: list = [None] * len(raw_contexts)
+        embedding: list[asyncio.Task] = []
+
+        async def embed_statements(texts: list[str]):
+            for text, vector in zip(texts, await batcher.embed(texts)):
+                streamed[text] = vector
+
+        async for i, response in stream_gpt_calls(
+            [adapter.get_statement_prompt(context) for context in raw_contexts],
+            progress_bar=True,
+        ):
+            responses[i] = response
+            if response:
+                embedding.append(
+                    asyncio.create_task(embed_statements(parse_statements(response)))
+                )
+
+        await asyncio.gather(*embedding)
+        return responses
+
+    async def extract():
+        print("Getting statements...")
+
+        if stream:
+            responses = await stream_extract()
+        else:
+            responses = await async_gpt_calls(
+                [adapter.get_statement_prompt(context) for context in raw_contexts],
+                progress_bar=True,
+                mode="auto",
+            )
+        check_failures(responses, "statement extractions")
+
+        # Identical statements share an ID, so duplicates across passages are
+        # merged here rather than clustered and compressed
+        statements: dict[str, dict] = {}
+        for response, context in zip(responses, raw_contexts):
+            for statement in parse_statements(response):
+                entry = statements.setdefault(
+                    content_hash(statement),
+                    dict(
+                        state["statements"].get(content_hash(statement))
+                        or {"statement": statement, "questions": []}
+                    ),
+                )
+                entry["questions"] = list(
+                    dict.fromkeys(entry["questions"] + contexts[context])
+                )
+        return statements
+
+    statements: dict[str, dict] = await run.stage("statements", extract)
+
+    # Existing vector ID -> statements it is made of, for every cluster that changes
+    changed: dict[str, list[str]] = {}
+
+    # Statements already in the namespace only gain question IDs, so their
+    # cluster is rewritten with the same members (and the same vector ID)
+    owners = {
+        statement_id: id
+        for id, statement_ids in state["clusters"].items()
+        for statement_id in statement_ids
+    }
+    for id in statements:
+        if id in owners:
+            changed[owners[id]] = list(state["clusters"][owners[id]])
+    ids = [id for id in statements if id not in owners]
+
+    async def embed():
+        print("Getting embeddings...")
+        texts = [statements[id]["statement"] for id in ids]
+        # Only statements that weren't streamed (or were extracted by an
+        # earlier run) still need embedding
+        missing = [text for text in dict.fromkeys(texts) if text not in streamed]
+        if missing:
+            embeddings = await get_embeddings(missing, progress_bar=True)
+            streamed.update(
+                {text: embedding.vector for text, embedding in zip(missing, embeddings)}
+            )
+        return [streamed[text] for text in texts]
+
+    embeddings = await run.stage("embeddings", embed, array=True)
+    vectors = {id: row for id, row in zip(ids, embeddings)}
+
+    async def group():
+        print("Clustering embeddings...")
+
+        # Full and incremental builds cluster the same way, so a statement
+        # ends up in the same kind of cluster whichever build adds it
+        clustering = asyncio.to_thread(
+            cluster,
+            [{"vector": vectors[id], "id": id} for id in ids],  # type: ignore
+            metric="cosine",
+            threshold=threshold,
+        )
+
+        if not (incremental and ids):
+            return {"clusters": await clustering, "changed": changed}
+
+        print("Matching existing clusters...")
+
+        clusters, matches = await asyncio.gather(
+            clustering,
+            multiple_queries(
+                [statements[id]["statement"] for id in ids], namespace, top_k=1  # type: ignore
+            ),
+        )
+        best = {
+            id: result[0]
+            for id, result in zip(ids, matches)
+            if result
+            and result[0].score >= threshold
+            and result[0].id in state["clusters"]
+        }
+
+        new_clusters = []
+        for members in clusters:
+            candidates = [best[id] for id in members if id in best]
+            if not candidates:
+                new_clusters.append(members)
+                continue
+            target = max(candidates, key=lambda match: match.score).id
+            changed.setdefault(target, list(state["clusters"][target]))
+            changed[target] += [id for id in members if id not in changed[target]]
+
+        return {"clusters": new_clusters, "changed": changed}
+
+    grouping = await run.stage("clusters", group)
+    changed = grouping["changed"]
+
+    if namespace and previous is None:
+        # Without a summary state there is no record of what the namespace
+        # holds (e.g. vectors with random IDs from before summaries were
+        # tracked), so it is emptied before anything is upserted
+        async def clear():
+            print(f"Clearing {namespace}...")
+            return await clear_index(namespace)
+
+        await run.stage("clear", clear)
+
+    state["statements"].update(statements)
+
+    clusters: list[list[str]] = grouping["clusters"] + list(changed.values())
+    no_compress = [cluster[0] for cluster in clusters if len(cluster) == 1]
+    to_compress = [cluster for cluster in clusters if len(cluster) > 1]
+
+    def questions(statement_ids: list[str]):
+        return list(
+            set(
+                [
+                    question
+                    for id in statement_ids
+                    for question in state["statements"][id]["questions"]
+                ]
+            )
+        )
+
+    async def singles():
+        # Untouched statements of changed clusters have no embedding in this
+        # run yet (they come from the embedding cache)
+        missing = [id for id in no_compress if id not in vectors]
+        if missing:
+            embeddings = await get_embeddings(
+                [state["statements"][id]["statement"] for id in missing]
+            )
+            vectors.update(
+                {id: embedding.vector for id, embedding in zip(missing, embeddings)}
+            )
+
+        return [
+            {
+                "id": id,
+                "values": [float(value) for value in vectors[id]],
+                "metadata": {
+                    "content": state["statements"][id]["statement"],
+                    "ids": state["statements"][id]["questions"],
+                },
+            }
+            for id in no_compress
+        ]
+
+    async def compress():
+        print("Compressing clusters...")
+
+        responses = await async_gpt_calls(
+            [
+                adapter.get_compress_prompt(
+                    [state["statements"][id]["statement"] for id in cluster]
+                )
+                for cluster in to_compress
+            ],
+            progress_bar=True,
+            mode="auto",
+        )
+        check_failures(responses, "compressions")
+        return [str(x) for x in responses]
+
+    async def compressed():
+        compressions = await run.stage(
+            "compressions", stream_compress if stream else compress
+        )
+
+        async def embed_compressions():
+            print("Updating embeddings...")
+            embeddings = await get_embeddings(compressions, progress_bar=True)
+            return [embedding.vector for embedding in embeddings]
+
+        compression_embeddings = await run.stage(
+            "compression_embeddings", embed_compressions, array=True
+        )
+
+        return [
+            {
+                "id": cluster_id(statement_ids),
+                "values": [float(value) for value in embedding],
+                "metadata": {"content": content, "ids": questions(statement_ids)},
+            }
+            for embedding, statement_ids, content in zip(
+                compression_embeddings, to_compress, compressions
+            )
+        ]
+
+    async def stream_compress():
+        print("Compressing clusters...")
+
+        compressions: list[str] = [""] * len(to_compress)
+        ready: asyncio.Queue = asyncio.Queue()
+        failures = 0
+
+        async def finish(i: int, content: str):
+            compressions[i] = content
+            vector = (await batcher.embed([content]))[0]
+            await ready.put(
+                {
+                    "id": cluster_id(to_compress[i]),
+                    "values": vector,
+                    "metadata": {"content": content, "ids": questions(to_compress[i])},
+                }
+            )
+
+        async def produce():
+            nonlocal failures
+            finishing: list[asyncio.Task] = []
+            try:
+                async for i, response in stream_gpt_calls(
+                    [
+                        adapter.get_compress_prompt(
+                            [state["statements"][id]["statement"] for id in cluster]
+                        )
+                        for cluster in to_compress
+                    ],
+                    progress_bar=True,
+                ):
+                    if isinstance(response, TaskFailure):
+                        failures += 1
+                    else:
+                        finishing.append(asyncio.create_task(finish(i, str(response))))
+                await asyncio.gather(*finishing)
+            finally:
+                await ready.put(None)
+
+        async def vectors():
+            for vector in await singles():
+                yield vector
+            while (vector := await ready.get()) is not None:
+                yield vector
+
+        producer = asyncio.create_task(produce())
+        try:
+            if namespace:
+                # Completion order varies between runs, so chunk checkpoints
+                # can't be trusted; upserts are idempotent with stable IDs
+                await upsert_index(
+                    namespace,
+                    vectors(),
+                    total=len(no_compress) + len(to_compress),
+                    progress=True,
+                    resume=False,
+                )
+            else:
+                async for _ in vectors():
+                    pass
+            await producer
+        finally:
+            producer.cancel()
+
+        if failures:
+            raise Exception(f"{failures} compressions failed, rerun to resume")
+        return compressions
+
+    async def upsert(name: str, vectors: list[dict]):
+        async def func():
+            print(f"Upserting {name}...")
+            return await upsert_index(namespace, vectors, progress=True)  # type: ignore
+
+        if namespace:
+            await run.stage("upsert_" + name, func)
+
+    async def single_branch():
+        vectors = await singles()
+        await upsert("statements", vectors)
+        return vectors
+
+    if stream:
+        # Everything was upserted while compressing
+        compressed_vectors = await compressed()
+        single_vectors = await singles()
+    else:
+        # Single statements are final as soon as clustering is, so they are
+        # upserted while the clusters are compressed (one upsert at a time, as
+        # each keeps a checkpoint for the namespace)
+        results = await asyncio.gather(
+            single_branch(), compressed(), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        single_vectors, compressed_vectors = results
+        await upsert("clusters", compressed_vectors)
+
+    final_contexts = single_vectors + compressed_vectors
+
+    if namespace:
+        new_ids = {vector["id"] for vector in final_contexts}
+
+        if incremental:
+            stale = [id for id in changed if id not in new_ids]
+            for id in changed:
+                del state["clusters"][id]
+        else:
+            stale = [
+                id for id in (previous or {}).get("clusters", {}) if id not in new_ids
+            ]
+
+        if stale:
+            print(f"Deleting {len(stale)} replaced vectors...")
+            await delete_from_index(namespace, stale)
+
+        state["clusters"].update({id: [id] for id in no_compress})
+        state["clusters"].update(
+            {cluster_id(statement_ids): statement_ids for statement_ids in to_compress}
+        )
+        state["contexts"] += [content_hash(context) for context in raw_contexts]
+
+        save_json(SUMMARY_DIR + namespace + ".json", state)
+
+    run.finish()
+
+    print("Done")
+
+    return final_contexts
@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import tiktoken
+
+# Per 1 Million Tokens
+prices = {
+    "gpt-4o": {"input": 2.5, "output": 10},
+    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+    "text-embedding-3-small": 0.02,
+    "text-embedding-3-large": 0.13,
+}
+
+# Batch API requests are billed at this fraction of the realtime price
+BATCH_DISCOUNT = 0.5
+
+current_stage: ContextVar[str] = ContextVar("current_stage", default="other")
+
+
+@contextmanager
+def stage(name: str):
+    """Attributes all API usage inside the block (and tasks it starts) to `name`."""
+    token = current_stage.set(name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+def get_price(model: str):
+    """Looks up the price entry for a model, including dated snapshots."""
+    for name in sorted(prices, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return prices[name]
+    return None
+
+
+def get_cost(model: str, prompt_tokens: int, completion_tokens=0):
+    price = get_price(model)
+    if price is None:
+        return 0.0
+    if isinstance(price, dict):
+        return (
+            prompt_tokens * price["input"] + completion_tokens * price["output"]
+        ) / 1_000_000
+    return prompt_tokens * price / 1_000_000
+
+
+encodings: dict[str, tiktoken.Encoding | None] = {}
+
+
+def get_encoding(model: str):
+    if model not in encodings:
+        try:
+            try:
+                encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            # The encoding files are downloaded on first use
+            encodings[model] = None
+    return encodings[model]
+
+
+def count_tokens(text: str, model="gpt-4o-mini"):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class StageUsage:
+    def __init__(self):
+        self.calls = 0
+        self.cached = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.saved = 0.0
+        self.latency = 0.0
+        # Batch calls have no per-request latency, so only realtime calls count
+        self.timed_calls = 0
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": round(self.cost, 6),
+            "saved": round(self.saved, 6),
+            "mean_latency": (
+                self.latency / self.timed_calls if self.timed_calls else None
+            ),
+        }
+
+
+class Ledger:
+    def __init__(self):
+        self.stages: dict[str, StageUsage] = {}
+
+    def get_stage(self):
+        return self.stages.setdefault(current_stage.get(), StageUsage())
+
+    def record(
+        self,
+        model: str,
+        prompt_tokens: int,
+        completion_tokens=0,
+        latency=0.0,
+        batch=False,
+    ):
+        usage = self.get_stage()
+        usage.calls += 1
+        usage.prompt_tokens += prompt_tokens
+        usage.completion_tokens += completion_tokens
+        usage.cost += get_cost(model, prompt_tokens, completion_tokens) * (
+            BATCH_DISCOUNT if batch else 1
+        )
+        if not batch:
+            usage.latency += latency
+            usage.timed_calls += 1
+
+    def record_cached(self, model: str, prompt_tokens: int, completion_tokens=0):
+        usage = self.get_stage()
+        usage.cached += 1
+        usage.saved += get_cost(model, prompt_tokens, completion_tokens)
+
+    def report(self):
+        stages = {name: usage.to_dict() for name, usage in self.stages.items()}
+        return {
+            "stages": stages,
+            "total_cost": round(sum(s.cost for s in self.stages.values()), 6),
+            "total_saved": round(sum(s.saved for s in self.stages.values()), 6),
+        }
+
+    def print(self):
+        report = self.report()
+        for name, usage in report["stages"].items():
+            print(
+                f"{name}: {usage['calls']} calls ({usage['cached']} cached), "
+                f"{usage['prompt_tokens']} in / {usage['completion_tokens']} out, "
+                f"${usage['cost']:.4f} (saved ${usage['saved']:.4f})"
+            )
+        print(
+            f"Total: ${report['total_cost']:.4f} (saved ${report['total_saved']:.4f})"
+        )
+
+    def reset(self):
+        self.stages = {}
+
+
+ledger = Ledger()
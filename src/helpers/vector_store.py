@@ -0,0 +1,596 @@
+import os
+import shutil
+import threading
+from json import dumps, loads
+
+import numpy as np
+from dotenv import load_dotenv
+
+from helpers.data import chunk_list
+from helpers.variables import SRC_DIR
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+load_dotenv()
+
+# "pinecone", "local" or "snapshot"
+VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "temp/vectors/")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "temp/snapshots/")
+
+# Local namespaces larger than this are searched with an HNSW graph when
+# hnswlib is installed; smaller ones (and filtered queries) are brute forced
+HNSW_THRESHOLD = 50_000
+
+# Threads (and Pinecone connections) available for index calls
+INDEX_POOL_SIZE = int(os.getenv("INDEX_POOL_SIZE", "32"))
+
+# Query vectors scored per matrix product in LocalStore.query_many
+QUERY_BLOCK_SIZE = 256
+
+
+class Match:
+    def __init__(
+        self,
+        id: str,
+        score: float,
+        metadata: dict | None = None,
+        values: list[float] | None = None,
+    ):
+        self.id = id
+        self.score = score
+        self.metadata = metadata
+        self.values = values or []
+
+    def __repr__(self):
+        return f"Match(id={self.id!r}, score={self.score:.4f})"
+
+
+class VectorStore:
+    name = ""
+    # Whether query_many answers many vectors in one call, rather than one
+    # request per vector
+    batch_queries = False
+
+    def query(
+        self,
+        namespace: str,
+        vector: list[float],
+        top_k=5,
+        include_metadata=False,
+        include_values=False,
+        filter: dict | None = None,
+    ) -> list:
+        raise NotImplementedError
+
+    def query_many(
+        self,
+        namespace: str,
+        vectors: list[list[float]],
+        top_k=5,
+        include_metadata=False,
+        include_values=False,
+        filter: dict | None = None,
+    ) -> list[list]:
+        return [
+            self.query(
+                namespace, vector, top_k, include_metadata, include_values, filter
+            )
+            for vector in vectors
+        ]
+
+    def upsert(self, namespace: str, vectors: list[dict]):
+        raise NotImplementedError
+
+    def delete(self, namespace: str, ids: list[str]):
+        raise NotImplementedError
+
+    def clear(self, namespace: str):
+        """Deletes every vector in the namespace."""
+        raise NotImplementedError
+
+    def namespace_size(self, namespace: str) -> int:
+        raise NotImplementedError
+
+    def list_page(
+        self, namespace: str, limit=100, token: str | None = None
+    ) -> tuple[list[str], str | None]:
+        """One page of vector IDs and the token for the next page (None at the end)."""
+        raise NotImplementedError
+
+    def fetch(self, namespace: str, ids: list[str]) -> list[dict]:
+        raise NotImplementedError
+
+
+class PineconeStore(VectorStore):
+    name = "pinecone"
+
+    def __init__(self):
+        self._index = None
+        self.lock = threading.Lock()
+
+    @property
+    def index(self):
+        # Created on first use so nothing fails at import without credentials
+        with self.lock:
+            if self._index is None:
+                from pinecone import Pinecone
+
+                api_key = os.getenv("PINECONE_API_KEY")
+                host = os.getenv("PINECONE_HOST")
+
+                if not api_key:
+                    raise Exception("Pinecone API Key not found")
+
+                if not host:
+                    raise Exception("Pinecone Host not found")
+
+                self._index = Pinecone(api_key=api_key).Index(
+                    host=host, pool_threads=INDEX_POOL_SIZE
+                )
+            return self._index
+
+    def query(
+        self,
+        namespace: str,
+        vector: list[float],
+        top_k=5,
+        include_metadata=False,
+        include_values=False,
+        filter: dict | None = None,
+    ):
+        response = self.index.query(
+            namespace=namespace,
+            vector=vector,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            include_values=include_values,
+            filter=filter or {},
+        )
+        return response.matches
+
+    def upsert(self, namespace: str, vectors: list[dict]):
+        # upsert_index already chunks and windows the calls
+        return [self.index.upsert(vectors=vectors, namespace=namespace)]
+
+    def delete(self, namespace: str, ids: list[str]):
+        for chunk in chunk_list(ids, 1000):
+            self.index.delete(ids=chunk, namespace=namespace)
+
+    def clear(self, namespace: str):
+        from pinecone.exceptions import NotFoundException
+
+        try:
+            self.index.delete(delete_all=True, namespace=namespace)
+        except NotFoundException:
+            # Nothing has been upserted to the namespace yet
+            pass
+
+    def namespace_size(self, namespace: str):
+        stats = self.index.describe_index_stats()
+        if namespace in stats.namespaces:
+            return stats.namespaces[namespace].vector_count
+        return 0
+
+    def list_page(self, namespace: str, limit=100, token: str | None = None):
+        response = self.index.list_paginated(
+            namespace=namespace, limit=limit, pagination_token=token
+        )
+        return (
+            [vector.id for vector in response.vectors],
+            response.pagination.next if response.pagination else None,
+        )
+
+    def fetch(self, namespace: str, ids: list[str]):
+        vectors = self.index.fetch(ids=ids, namespace=namespace).vectors
+        return [
+            {
+                "id": vectors[id].id,
+                "values": list(vectors[id].values),
+                "metadata": dict(vectors[id].metadata or {}),
+            }
+            for id in ids
+            if id in vectors
+        ]
+
+
+def matches_value(value, condition) -> bool:
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+
+    # As in Pinecone, a list field matches if any of its elements do
+    values = value if isinstance(value, list) else [value]
+
+    for operator, target in condition.items():
+        if operator == "$exists":
+            matched = (value is not None) == target
+        elif operator == "$eq":
+            matched = target in values
+        elif operator == "$ne":
+            matched = target not in values
+        elif operator == "$in":
+            matched = any(v in target for v in values)
+        elif operator == "$nin":
+            matched = not any(v in target for v in values)
+        elif operator in ["$gt", "$gte", "$lt", "$lte"]:
+            matched = value is not None and {
+                "$gt": value > target,
+                "$gte": value >= target,
+                "$lt": value < target,
+                "$lte": value <= target,
+            }[operator]
+        else:
+            raise Exception(f"Unsupported filter operator: {operator}")
+        if not matched:
+            return False
+
+    return True
+
+
+def matches_filter(metadata: dict, filter: dict) -> bool:
+    """Evaluates a Pinecone (Mongo-style) metadata filter."""
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, f) for f in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, f) for f in condition):
+                return False
+        elif not matches_value(metadata.get(key), condition):
+            return False
+    return True
+
+
+class LocalNamespace:
+    """Vectors and metadata for one namespace, kept in memory and on disk.
+
+    vectors.f32 holds raw float32 rows and metadata.jsonl one line per write,
+    so upserts append (or overwrite a row in place) instead of rewriting the
+    namespace. The last metadata line for a position wins.
+    """
+
+    exact = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        self.buffer = np.zeros((0, 0), dtype=np.float32)
+        self.graph = None
+        lines = 0
+
+        if os.path.exists(path + "index.json"):
+            with open(path + "index.json", "r") as f:
+                dimension = loads(f.read())["dimension"]
+            with open(path + "metadata.jsonl", "r") as f:
+                for line in f:
+                    item = loads(line)
+                    if item["position"] == len(self.ids):
+                        self.ids.append(item["id"])
+                        self.metadata.append(item["metadata"])
+                    else:
+                        self.ids[item["position"]] = item["id"]
+                        self.metadata[item["position"]] = item["metadata"]
+                    lines += 1
+            # Rows written after the last metadata line belong to an
+            # interrupted upsert and are dropped
+            self.buffer = np.fromfile(path + "vectors.f32", dtype=np.float32)
+            self.buffer = self.buffer[: len(self.ids) * dimension].reshape(
+                -1, dimension
+            )
+
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+        self._norms: np.ndarray | None = None
+
+        if lines > len(self.ids):
+            self.save()
+
+    @property
+    def vectors(self):
+        return self.buffer[: len(self.ids)]
+
+    @property
+    def norms(self):
+        if self._norms is None:
+            self._norms = np.linalg.norm(self.vectors, axis=1)
+        return self._norms
+
+    def save(self):
+        """Rewrites the namespace compactly."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.path + "index.json", "w") as f:
+            f.write(dumps({"dimension": self.buffer.shape[1]}))
+        self.vectors.tofile(self.path + "vectors.f32.part")
+        with open(self.path + "metadata.jsonl.part", "w") as f:
+            for i, (id, metadata) in enumerate(zip(self.ids, self.metadata)):
+                f.write(dumps({"id": id, "position": i, "metadata": metadata}) + "\n")
+        os.replace(self.path + "vectors.f32.part", self.path + "vectors.f32")
+        os.replace(self.path + "metadata.jsonl.part", self.path + "metadata.jsonl")
+
+    def grow(self, rows: int, dimension: int):
+        if len(self.ids) + rows <= len(self.buffer):
+            return
+        capacity = max(1024, len(self.ids) + rows, len(self.buffer) * 2)
+        buffer = np.zeros((capacity, dimension), dtype=np.float32)
+        if len(self.ids):
+            buffer[: len(self.ids)] = self.vectors
+        self.buffer = buffer
+
+    def upsert(self, vectors: list[dict]):
+        if not vectors:
+            return
+
+        with self.lock:
+            rows = np.asarray([v["values"] for v in vectors], dtype=np.float32)
+
+            if not len(self.ids):
+                os.makedirs(self.path, exist_ok=True)
+                with open(self.path + "index.json", "w") as f:
+                    f.write(dumps({"dimension": rows.shape[1]}))
+                open(self.path + "vectors.f32", "wb").close()
+                open(self.path + "metadata.jsonl", "w").close()
+
+            self.grow(len(rows), rows.shape[1])
+
+            lines = []
+            with open(self.path + "vectors.f32", "r+b") as f:
+                for vector, row in zip(vectors, rows):
+                    position = self.positions.get(vector["id"])
+                    if position is None:
+                        position = len(self.ids)
+                        self.positions[vector["id"]] = position
+                        self.ids.append(vector["id"])
+                        self.metadata.append({})
+                    self.buffer[position] = row
+                    self.metadata[position] = vector.get("metadata") or {}
+                    f.seek(position * row.nbytes)
+                    f.write(row.tobytes())
+                    lines.append(
+                        dumps(
+                            {
+                                "id": vector["id"],
+                                "position": position,
+                                "metadata": self.metadata[position],
+                            }
+                        )
+                        + "\n"
+                    )
+
+            with open(self.path + "metadata.jsonl", "a") as f:
+                f.writelines(lines)
+
+            self._norms = None
+            self.graph = None
+
+    def delete(self, ids: list[str]):
+        """Removes rows and rewrites the namespace (deletes are rare, so this is fine)."""
+        with self.lock:
+            removed = {self.positions[id] for id in ids if id in self.positions}
+            if not removed:
+                return
+            keep = [i for i in range(len(self.ids)) if i not in removed]
+            self.buffer = np.ascontiguousarray(self.vectors[keep])
+            self.ids = [self.ids[i] for i in keep]
+            self.metadata = [self.metadata[i] for i in keep]
+            self.positions = {id: i for i, id in enumerate(self.ids)}
+            self._norms = None
+            self.graph = None
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            self.ids = []
+            self.metadata = []
+            self.positions = {}
+            self.buffer = np.zeros((0, 0), dtype=np.float32)
+            self._norms = None
+            self.graph = None
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def get_graph(self):
+        # Only called from search, with the lock held
+        if self.graph is None:
+            graph = hnswlib.Index(space="cosine", dim=self.vectors.shape[1])  # type: ignore
+            graph.init_index(max_elements=len(self.ids), ef_construction=200, M=16)
+            graph.add_items(self.vectors, np.arange(len(self.ids)))
+            self.graph = graph
+        return self.graph
+
+    def search(self, queries: np.ndarray, top_k: int, filter: dict | None):
+        """Returns (positions, cosine scores) of the best `top_k` rows per query.
+        The caller holds the lock."""
+        if filter:
+            mask = np.array([matches_filter(m, filter) for m in self.metadata])
+            top_k = min(top_k, int(mask.sum()))
+        else:
+            mask = None
+            top_k = min(top_k, len(self.ids))
+
+        if top_k <= 0:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0))] * len(queries)
+
+        if (
+            hnswlib is not None
+            and not self.exact
+            and mask is None
+            and len(self.ids) > HNSW_THRESHOLD
+        ):
+            graph = self.get_graph()
+            graph.set_ef(max(64, top_k * 2))
+            labels, distances = graph.knn_query(queries, k=top_k)
+            return list(zip(labels.astype(np.int64), 1 - distances))
+
+        results = []
+
+        for start in range(0, len(queries), QUERY_BLOCK_SIZE):
+            block = queries[start : start + QUERY_BLOCK_SIZE]
+            scores = (block @ self.vectors.T) / np.maximum(
+                np.outer(np.linalg.norm(block, axis=1), self.norms), 1e-12
+            )
+            if mask is not None:
+                scores[:, ~mask] = -np.inf
+
+            positions = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            for row, candidates in zip(scores, positions):
+                candidates = candidates[np.argsort(-row[candidates])]
+                results.append((candidates, row[candidates]))
+
+        return results
+
+
+class SnapshotNamespace(LocalNamespace):
+    """A read-only namespace memory-mapped from an export_namespace snapshot."""
+
+    # Always brute force, so results are identical from run to run
+    exact = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ids: list[str] = []
+        self.metadata: list[dict] = []
+        self.buffer = np.zeros((0, 0), dtype=np.float32)
+        self.graph = None
+        self._norms = None
+
+        if os.path.exists(path + "vectors.npy"):
+            self.buffer = np.load(path + "vectors.npy", mmap_mode="r")
+            with open(path + "metadata.jsonl", "r") as f:
+                for line in f:
+                    item = loads(line)
+                    self.ids.append(item["id"])
+                    self.metadata.append(item["metadata"])
+
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+
+    def upsert(self, vectors: list[dict]):
+        raise Exception("Snapshots are read-only, restore them into a store instead")
+
+    def delete(self, ids: list[str]):
+        raise Exception("Snapshots are read-only, restore them into a store instead")
+
+    def clear(self):
+        raise Exception("Snapshots are read-only, restore them into a store instead")
+
+
+class LocalStore(VectorStore):
+    """An on-disk index under LOCAL_VECTOR_DIR, one folder per namespace."""
+
+    name = "local"
+    namespace_class = LocalNamespace
+    batch_queries = True
+
+    def __init__(self, path=LOCAL_VECTOR_DIR):
+        self.path = SRC_DIR + path
+        self.namespaces: dict[str, LocalNamespace] = {}
+        self.lock = threading.Lock()
+
+    def get_namespace(self, namespace: str):
+        with self.lock:
+            if namespace not in self.namespaces:
+                self.namespaces[namespace] = self.namespace_class(
+                    self.path + namespace + "/"
+                )
+            return self.namespaces[namespace]
+
+    def query(
+        self,
+        namespace: str,
+        vector: list[float],
+        top_k=5,
+        include_metadata=False,
+        include_values=False,
+        filter: dict | None = None,
+    ):
+        return self.query_many(
+            namespace, [vector], top_k, include_metadata, include_values, filter
+        )[0]
+
+    def query_many(
+        self,
+        namespace: str,
+        vectors: list[list[float]],
+        top_k=5,
+        include_metadata=False,
+        include_values=False,
+        filter: dict | None = None,
+    ):
+        space = self.get_namespace(namespace)
+        # Held until the matches are built, since upserts can reallocate the
+        # buffer and deletes move rows
+        with space.lock:
+            results = space.search(
+                np.asarray(vectors, dtype=np.float32), top_k, filter
+            )
+            return [
+                [
+                    Match(
+                        space.ids[i],
+                        float(score),
+                        dict(space.metadata[i]) if include_metadata else None,
+                        space.vectors[i].tolist() if include_values else None,
+                    )
+                    for i, score in zip(positions, scores)
+                ]
+                for positions, scores in results
+            ]
+
+    def upsert(self, namespace: str, vectors: list[dict]):
+        self.get_namespace(namespace).upsert(vectors)
+        return [{"upserted_count": len(vectors)}]
+
+    def delete(self, namespace: str, ids: list[str]):
+        self.get_namespace(namespace).delete(ids)
+
+    def clear(self, namespace: str):
+        self.get_namespace(namespace).clear()
+
+    def namespace_size(self, namespace: str):
+        return len(self.get_namespace(namespace).ids)
+
+    def list_page(self, namespace: str, limit=100, token: str | None = None):
+        space = self.get_namespace(namespace)
+        start = int(token or 0)
+        end = start + limit
+        with space.lock:
+            return space.ids[start:end], str(end) if end < len(space.ids) else None
+
+    def fetch(self, namespace: str, ids: list[str]):
+        space = self.get_namespace(namespace)
+        with space.lock:
+            return [
+                {
+                    "id": id,
+                    "values": space.vectors[space.positions[id]].tolist(),
+                    "metadata": dict(space.metadata[space.positions[id]]),
+                }
+                for id in ids
+                if id in space.positions
+            ]
+
+
+class SnapshotStore(LocalStore):
+    """Serves namespaces from snapshots under SNAPSHOT_DIR, without any network."""
+
+    name = "snapshot"
+    namespace_class = SnapshotNamespace
+
+    def __init__(self, path=SNAPSHOT_DIR):
+        super().__init__(path)
+
+
+def get_store(name=VECTOR_STORE) -> VectorStore:
+    if name == "pinecone":
+        return PineconeStore()
+    if name == "local":
+        return LocalStore()
+    if name == "snapshot":
+        return SnapshotStore()
+    raise Exception(f"Unknown vector store: {name}")
+
+
+store = get_store()
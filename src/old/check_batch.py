@@ -1,3 +1,4 @@
-from helpers.oai import client
+import asyncio
+from helpers.batch import batches
 
-print(client.batches.retrieve(input("Enter batch ID: ")).status)
+print(asyncio.run(batches.status(input("Enter batch ID: "))).status)
@@ -1,9 +1,9 @@
-from helpers.data import save_file, stringify
-from helpers.pc import query_index
+import asyncio
 
-results = query_index("a", "pubmed_summarized", top_k=10000, include_vector=True)
+from helpers.pc import export_namespace
 
-save_file(
-    "data/pubmed_summarized.json",
-    stringify([{"id": x.id, "vector": x.values} for x in results.matches]),
+print(
+    asyncio.run(
+        export_namespace("pubmed_summarized", "data/pubmed_summarized/", progress=True)
+    )
 )
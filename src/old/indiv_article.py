@@ -1,9 +1,7 @@
 import asyncio
 import json
-from uuid import uuid4
 
-from helpers.dbscan import cluster
-from helpers.oai import async_gpt_calls, get_embeddings
+from helpers.summarize import Adapter, summarize
 
 NEWLINE = "\n"
 
@@ -81,74 +79,16 @@ async def summarize_two_articles():
     The release of Gemini 2.0 marks a significant step in our journey to create more capable and helpful AI tools. With these advancements, we continue to push the boundaries of what’s possible, bringing us closer to our vision of AI that truly assists in all domains of life.
     """
 
-    raw_contexts = [article1, article2]
-
-    print("Getting statements...")
-    new_contexts = [
-        str(x).replace("\n- ", "\n").strip().removeprefix("- ")
-        for x in await async_gpt_calls(
-            [get_statement_prompt(context) for context in raw_contexts],
-            progress_bar=True,
-        )
-    ]
-
-    statements = []
-    for statement_list in new_contexts:
-        for statement in statement_list.split("\n"):
-            if statement.strip() != "":
-                statements.append(
-                    {
-                        "statement": statement.strip(),
-                        "id": str(uuid4()),
-                    }
-                )
-
-    statement_id_to_statement = {s["id"]: s for s in statements}
-
-    print("Getting embeddings...")
-    embeddings = await get_embeddings([s["statement"] for s in statements], progress_bar=True)
-    for s, e in zip(statements, embeddings):
-        s["vector"] = e.vector
-
-    print("Clustering embeddings...")
-    clusters = cluster(
-        [
-            {"vector": e.vector, "id": s["id"]}
-            for e, s in zip(embeddings, statements)
-        ],
+    adapter = Adapter(
+        "indiv_article",
+        lambda: {article1: [], article2: []},
+        get_statement_prompt,
+        get_compress_prompt,
     )
 
-    print("Compressing clusters...")
-    no_compress = [c[0] for c in clusters if len(c) == 1]
-    to_compress = [c for c in clusters if len(c) > 1]
-
-    compress_prompts = [
-        get_compress_prompt([statement_id_to_statement[id]["statement"] for id in cluster])
-        for cluster in to_compress
-    ]
-
-    compressions = [
-        str(x)
-        for x in await async_gpt_calls(compress_prompts, progress_bar=True)
-    ]
-
-    final_contexts = [
-        {
-            "id": statement_id_to_statement[statement_id]["id"],
-            "content": statement_id_to_statement[statement_id]["statement"],
-        }
-        for statement_id in no_compress
-    ]
-
-    for embedding, cluster_ids, content in zip(compressions, to_compress, compressions):
-        final_contexts.append(
-            {
-                "id": str(uuid4()),
-                "content": content,
-            }
-        )
-
-    all_statements = [fc["content"] for fc in final_contexts]
+    final_contexts = await summarize(adapter)
+
+    all_statements = [fc["metadata"]["content"] for fc in final_contexts]
     total_characters = sum(len(s) for s in all_statements)
 
     output = {
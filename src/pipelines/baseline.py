@@ -4,6 +4,7 @@ import asyncio
 
 from helpers.pc import content_from_query_result, query_index
 from helpers.progress import Progress
+from helpers.usage import stage
 
 NEWLINE = "\n"
 
@@ -20,13 +21,15 @@ def get_prompt(question: str, contexts: list[str]):
     Respond with a yes, no, or maybe decision at the end."""
 
 async def run_raw(namespace: str, prompt: str, progress: Progress | None = None):
-    context = query_index(
-        prompt, namespace, min_score=0.55, include_metadata=True 
-    )
-
-    response = str(await async_call_gpt(
-        get_prompt(prompt, content_from_query_result(context))
-    )).strip()
+    with stage("retrieve"):
+        context = await query_index(
+            prompt, namespace, min_score=0.55, include_metadata=True
+        )
+
+    with stage("answer"):
+        response = str(await async_call_gpt(
+            get_prompt(prompt, content_from_query_result(context))
+        )).strip()
 
     decision = response.splitlines()[-1].strip() if response else None
 
@@ -1,13 +1,15 @@
 import traceback
-from helpers.oai import async_call_gpt
+from helpers.oai import async_call_gpt, estimate_gpt_calls
 import asyncio
 
 from helpers.pc import (
+    ESTIMATE_CONTEXTS,
     async_query_index,
     content_from_query_result,
     multiple_queries,
 )
 from helpers.progress import Progress
+from helpers.usage import stage
 
 
 def get_prompt(question: str, contexts: list[str]):
@@ -70,39 +72,49 @@ Respond with as few questions as possible.
 Each question should be comprehensible if it were taken out of context, and it should not refer to the context or question."""
 
 
-async def run_raw(namespace: str, prompt: str, progress: Progress | None = None):
-    try:
-        context = content_from_query_result(
-            await async_query_index(
-                prompt, namespace, min_score=0.4, include_metadata=True  # type: ignore
-            )
-        )
+def estimate_raw(questions: list[str]):
+    """Pre-flight estimate for run_raw, assuming the first retrieval is enough."""
+    return estimate_gpt_calls(
+        [context_is_enough(question, ESTIMATE_CONTEXTS) for question in questions]
+        + [get_prompt(question, ESTIMATE_CONTEXTS) for question in questions]
+    )
 
-        i = 0
 
-        while i < 5 and not await is_enough(prompt, context):
-            new_queries = await async_call_gpt(
-                more_context_query(prompt, context),
-                system="Respond extremely concisely and only with the questions. Separate each question with a newline and no bullet points.",
-            )
-            contexts = await multiple_queries(
-                [
-                    query.strip()
-                    for query in str(new_queries).strip().split("\n")
-                    if query.strip()
-                ],
-                namespace,
-                min_score=0.4,
-                include_metadata=True,
+async def run_raw(namespace: str, prompt: str, progress: Progress | None = None):
+    try:
+        with stage("retrieve"):
+            context = content_from_query_result(
+                await async_query_index(
+                    prompt, namespace, min_score=0.4, include_metadata=True  # type: ignore
+                )
             )
-            for new_context in contexts:
-                context += content_from_query_result(new_context)
-
-            context = list(dict.fromkeys(context))
-
-            i += 1
 
-        response = await async_call_gpt(get_prompt(prompt, context))
+            i = 0
+
+            while i < 5 and not await is_enough(prompt, context):
+                new_queries = await async_call_gpt(
+                    more_context_query(prompt, context),
+                    system="Respond extremely concisely and only with the questions. Separate each question with a newline and no bullet points.",
+                )
+                contexts = await multiple_queries(
+                    [
+                        query.strip()
+                        for query in str(new_queries).strip().split("\n")
+                        if query.strip()
+                    ],
+                    namespace,
+                    min_score=0.4,
+                    include_metadata=True,
+                )
+                for new_context in contexts:
+                    context += content_from_query_result(new_context)
+
+                context = list(dict.fromkeys(context))
+
+                i += 1
+
+        with stage("answer"):
+            response = await async_call_gpt(get_prompt(prompt, context))
 
         result = {
             "question": prompt,
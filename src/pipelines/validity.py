@@ -1,9 +1,15 @@
-from helpers.data import get_number
-from helpers.oai import async_call_gpt, async_gpt_calls
+from helpers.data import TaskFailure, get_number
+from helpers.oai import async_call_gpt, async_gpt_calls, estimate_gpt_calls
 import asyncio
 
-from helpers.pc import content_from_query_result, multiple_queries, query_index
+from helpers.pc import (
+    ESTIMATE_CONTEXTS,
+    content_from_query_result,
+    multiple_queries,
+    query_index,
+)
 from helpers.progress import Progress
+from helpers.usage import stage
 
 NEWLINE = "\n"
 
@@ -107,28 +113,79 @@ Your last line should be the answer and nothing else, no periods, no text (yes,
 Your new answer can be the same as the initial answer or different."""
 
 
-async def run_validity(namespace: str, prompt: str, progress: Progress | None = None):
-    context = query_index(
-        prompt, namespace, min_score=0.4, include_metadata=True  # type: ignore
-    )
-
-    response = await async_call_gpt(
-        get_prompt(prompt, content_from_query_result(context))
-    )
-
-    validity, raw_statements = await async_gpt_calls(
-        [
-            get_validity_prompt(
-                prompt, content_from_query_result(context), str(response)
-            ),
-            get_statement_list_prompt(
-                prompt, content_from_query_result(context), str(response)
-            ),
+def get_decision_prompt(question: str, answer: str):
+    return f"""Please extract a one-word decision from the text that was answering this question (yes, no, maybe).
+Question:
+{question}
+
+Answer:
+{answer}"""
+
+
+def estimate_validity(questions: list[str], statements=5):
+    """Pre-flight estimate for run_validity, assuming `statements` statements per
+    answer and no correction."""
+    response = "lorem ipsum " * 100
+    prompts = []
+    for question in questions:
+        prompts += [
+            get_prompt(question, ESTIMATE_CONTEXTS),
+            get_validity_prompt(question, ESTIMATE_CONTEXTS, response),
+            get_statement_list_prompt(question, ESTIMATE_CONTEXTS, response),
+            get_decision_prompt(question, response),
         ]
-    )
+        prompts += [
+            get_statement_validity_prompt(ESTIMATE_CONTEXTS, question)
+        ] * statements
+    return estimate_gpt_calls(prompts)
+
+
+async def run_validity(namespace: str, prompt: str, progress: Progress | None = None):
+    with stage("retrieve"):
+        context = await query_index(
+            prompt, namespace, min_score=0.4, include_metadata=True  # type: ignore
+        )
+
+    with stage("answer"):
+        response = await async_call_gpt(
+            get_prompt(prompt, content_from_query_result(context))
+        )
+
+    async def get_validity():
+        with stage("validity"):
+            return (
+                await async_gpt_calls(
+                    [
+                        get_validity_prompt(
+                            prompt, content_from_query_result(context), str(response)
+                        )
+                    ]
+                )
+            )[0]
+
+    async def get_statements():
+        with stage("statement"):
+            return (
+                await async_gpt_calls(
+                    [
+                        get_statement_list_prompt(
+                            prompt, content_from_query_result(context), str(response)
+                        )
+                    ]
+                )
+            )[0]
+
+    validity, raw_statements = await asyncio.gather(get_validity(), get_statements())
+
+    if isinstance(validity, TaskFailure):
+        raise Exception(f"Error getting validity: {validity.error}") from validity.error
 
     validity_float = float(get_number(str(validity).strip()))
 
+    if isinstance(raw_statements, TaskFailure):
+        # Without statements the answer is judged on its validity alone
+        raw_statements = ""
+
     statements = [
         {
             "importance": float(
@@ -140,23 +197,25 @@ async def run_validity(namespace: str, prompt: str, progress: Progress | None =
         if "[" in statement
     ]
 
-    statement_contexts = await multiple_queries(
-        [s["statement"] for s in statements],
-        namespace,
-        min_score=0.65,
-        include_metadata=True,
-    )
-
-    raw_statement_validities = await async_gpt_calls(
-        [
-            get_statement_validity_prompt(
-                # content_from_query_result(statement["original_context"]) +
-                content_from_query_result(contexts),
-                statement["statement"],
-            )
-            for statement, contexts in zip(statements, statement_contexts)
-        ],
-    )
+    with stage("retrieve"):
+        statement_contexts = await multiple_queries(
+            [s["statement"] for s in statements],
+            namespace,
+            min_score=0.65,
+            include_metadata=True,
+        )
+
+    with stage("statement"):
+        raw_statement_validities = await async_gpt_calls(
+            [
+                get_statement_validity_prompt(
+                    # content_from_query_result(statement["original_context"]) +
+                    content_from_query_result(contexts),
+                    statement["statement"],
+                )
+                for statement, contexts in zip(statements, statement_contexts)
+            ],
+        )
 
     statement_validities = [
         {
@@ -166,6 +225,8 @@ async def run_validity(namespace: str, prompt: str, progress: Progress | None =
             "validity_judgement": str(validity),
         }
         for validity, statement in zip(raw_statement_validities, statements)
+        # Statements whose check failed on every retry are left out
+        if not isinstance(validity, TaskFailure)
     ]
 
     total_statement_validity = sum(
@@ -181,30 +242,34 @@ async def run_validity(namespace: str, prompt: str, progress: Progress | None =
     }
 
     if (validity_float * 0.6 + total_statement_validity * 0.4) < 0.7:
-        correction = await async_call_gpt(
-            get_correction_prompt(
-                prompt,
-                content_from_query_result(context),
-                str(response),
-                [
-                    f"""{s["statement"]} [Validity: {s["validity"]}] [Importance: {s["importance"]}]"""
-                    for s in statement_validities
-                ],
-                str(validity),
+        with stage("correction"):
+            correction = await async_call_gpt(
+                get_correction_prompt(
+                    prompt,
+                    content_from_query_result(context),
+                    str(response),
+                    [
+                        f"""{s["statement"]} [Validity: {s["validity"]}] [Importance: {s["importance"]}]"""
+                        for s in statement_validities
+                    ],
+                    str(validity),
+                )
             )
-        )
         result["correction"] = str(correction)
 
-    result["decision"] = str(
-        await async_call_gpt(
-            f"""Please extract a one-word decision from the text that was answering this question (yes, no, maybe).
-Question:
-{prompt}
-
-Answer:
-{result["correction"] if "correction" in result else result["response"]}"""
+    with stage("decision"):
+        result["decision"] = str(
+            await async_call_gpt(
+                get_decision_prompt(
+                    prompt,
+                    (
+                        result["correction"]
+                        if "correction" in result
+                        else result["response"]
+                    ),
+                )
+            )
         )
-    )
 
     if progress:
         progress.increment()
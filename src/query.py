@@ -1,5 +1,5 @@
 import asyncio
-from helpers.pc import query_index
+from helpers.pc import content_from_query_result, query_index
 
 
 namespaces = [
@@ -28,8 +28,7 @@ print(f"Using namespace: {namespace}")
 query = input("Enter query: ")
 
 print(
-    [
-        x.metadata["content"]
-        for x in asyncio.run(query_index(query, namespace, include_metadata=True))
-    ]
+    content_from_query_result(
+        asyncio.run(query_index(query, namespace, include_metadata=True)), namespace
+    )
 )
@@ -8,6 +8,8 @@ from benchmarks.squad.summarizer import squad_summarized
 from benchmarks.hotpot.raw import hotpot_raw
 from benchmarks.squad.validity import squad_validity
 from helpers.input import function_from_list
+from helpers.pc import index_stats, retrieval_stats
+from helpers.usage import ledger
 
 programs = {
     "PubMed QA: Raw Batch": pubmed_raw,
@@ -23,3 +25,8 @@ programs = {
 
 if __name__ == "__main__":
     function_from_list("What benchmark would you like to run?", programs)
+    ledger.print()
+    for operation, stats in index_stats().items():
+        print(f"Index {operation}: {stats}")
+    for level, stats in retrieval_stats().items():
+        print(f"Retrieval cache ({level}): {stats}")
@@ -1,3 +1,5 @@
+from functools import partial
+
 from database.hotpot.raw import hotpot_raw
 from database.hotpot.summarizer import hotpot_summarize
 from database.pubmed.raw import pubmed_raw
@@ -8,11 +10,20 @@ from helpers.input import function_from_list
 
 programs = {
     "PubMed QA: Raw": pubmed_raw,
+    "PubMed QA: Raw (Batch API)": partial(pubmed_raw, batch=True),
     "PubMed QA: Summarized": pubmed_summarize,
+    "PubMed QA: Summarized (Incremental)": partial(pubmed_summarize, incremental=True),
+    "PubMed QA: Summarized (Streaming)": partial(pubmed_summarize, stream=True),
     "Sqaud: Raw": squad_raw,
+    "Squad: Raw (Batch API)": partial(squad_raw, batch=True),
     "Squad: Summarized": squad_summarize,
+    "Squad: Summarized (Incremental)": partial(squad_summarize, incremental=True),
+    "Squad: Summarized (Streaming)": partial(squad_summarize, stream=True),
     "Hotpot: Raw": hotpot_raw,
+    "Hotpot: Raw (Batch API)": partial(hotpot_raw, batch=True),
     "Hotpot: Summarized": hotpot_summarize,
+    "Hotpot: Summarized (Incremental)": partial(hotpot_summarize, incremental=True),
+    "Hotpot: Summarized (Streaming)": partial(hotpot_summarize, stream=True),
 }
 
 if __name__ == "__main__":
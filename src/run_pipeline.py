@@ -1,14 +1,16 @@
 from helpers.data import save_json
-from pipelines.raw import run_raw
+from helpers.oai import print_estimate
+from pipelines.raw import estimate_raw, run_raw
 from pipelines.validity import run_validity
+from helpers.usage import ledger
 import asyncio
 
+question = "Do mitochondria play a role in remodelling lace plant leaves during programmed cell death?"
 
-result = asyncio.run(
-    run_raw(
-        "pubmed_summarized",
-        "Do mitochondria play a role in remodelling lace plant leaves during programmed cell death?",
-    )
-)
+print_estimate(estimate_raw([question]))
+
+result = asyncio.run(run_raw("pubmed_summarized", question))
 
 save_json("temp/pubmed_summarized.json", result)
+
+ledger.print()
@@ -0,0 +1,23 @@
+import asyncio
+
+from helpers.pc import restore_namespace, snapshot_namespace
+
+namespaces = [
+    f"{dataset}_{kind}"
+    for dataset in ["pubmed", "squad", "hotpot"]
+    for kind in ["raw", "summarized"]
+]
+
+print("Choose a namespace:")
+for i, namespace in enumerate(namespaces):
+    print(f"{i + 1}. {namespace}")
+
+namespace = namespaces[int(input()) - 1]
+
+print("1. Snapshot (save the namespace to disk)")
+print("2. Restore (upsert the snapshot into the current vector store)")
+
+if input() == "2":
+    print(asyncio.run(restore_namespace(namespace, progress=True)))
+else:
+    print(asyncio.run(snapshot_namespace(namespace, progress=True)))